@@ -0,0 +1,501 @@
+"""
+Benchmarks comparing freshly translated ABMs against the translations stored alongside each sample.
+
+Each benchmark re-runs a sample's `translate.py` (so PyPRAM must be installed, as for translation) into a temporary
+directory, copies the sample's stored Groups JSON over the new one so both models start from the same population, and
+then times both models over the same number of steps.
+
+Run from the repository root, e.g.:
+    python -m Samples.benchmark matches_qry
+"""
+
+from mesa.datacollection import DataCollector
+from functools import partial
+from unittest import mock
+import ctypes
+import importlib
+import itertools
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import warnings
+
+import pram2mesa as pram2mesa_package
+
+SAMPLES = os.path.dirname(os.path.realpath(__file__))
+
+# sample folder: (name passed to pram2mesa in translate.py, folder of the stored translation)
+SAMPLE_NAMES = {
+    'SIRS': ('SIRSModel', 'SIRSModel'),
+    'Segregation': ('SegregationModel', 'SegregationModel'),
+    'Migration': ('Migration', 'Migration'),
+    'Allegheny_Flu': ('Allegheny_Flu', 'Allegheny_Flu')
+}
+
+# edits made by hand to a sample's stored translation (see Samples/README.md), as (old code, new code) pairs, which are
+# made to its fresh translations too
+MANUAL_EDITS = {
+    # the module-level sites_dst of translate.py is not carried over by translation
+    'Migration': [('random.choice(sites_dst)', "random.choice([s for s in pop.grid.G.nodes if s != 'Sudan'])")]
+}
+
+_translations = itertools.count()
+
+
+def stored_model(sample, groups=None):
+    """
+    Imports the Model class of the translation stored in a sample's folder.
+    :param sample: The name of a folder in Samples, e.g. 'SIRS'
+    :param groups: The name of another Groups JSON file in the stored translation's folder (or the path of any other)
+                   to start from, or None
+    :return: The Model class
+    """
+    name, folder = SAMPLE_NAMES[sample]
+    if groups is None:
+        module = importlib.import_module(f'Samples.{sample}.{folder}.{name}Model')
+        return getattr(module, f'{name}Model')
+
+    # the stored translation always loads {name}Groups.json, so copy it somewhere that file can be replaced
+    tmp = tempfile.mkdtemp(prefix='pram2mesa_bench_')
+    shutil.copytree(os.path.join(SAMPLES, sample, folder), os.path.join(tmp, name))
+    return _import_translation(sample, tmp, groups)
+
+
+def translate(sample, groups=None, **options):
+    """
+    Translates a sample's PRAM with the current version of pram2mesa into a temporary directory and imports the
+    resulting Model class.
+    :param sample: The name of a folder in Samples, e.g. 'SIRS'
+    :param groups: The name of a Groups JSON file in the stored translation's folder to start from, or None for the
+                   stored translation's own
+    :param options: Keyword arguments passed on to pram2mesa
+    :return: The Model class
+    """
+    translator = sys.modules['pram2mesa.pram2mesa']
+    configured = partial(translator.pram2mesa, **options)
+    tmp = tempfile.mkdtemp(prefix='pram2mesa_bench_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmp)
+        # translate.py calls pram2mesa at import time; inject the options wherever it may import it from. It is run
+        # as __main__, as only rules declared there (or in pram) are translated
+        with mock.patch.object(translator, 'pram2mesa', configured), \
+                mock.patch.object(pram2mesa_package, 'pram2mesa', configured):
+            runpy.run_path(os.path.join(SAMPLES, sample, 'translate.py'), run_name='__main__')
+    finally:
+        os.chdir(cwd)
+    _apply_manual_edits(sample, tmp)
+    return _import_translation(sample, tmp, groups)
+
+
+def _apply_manual_edits(sample, tmp):
+    """
+    Makes the edits listed in MANUAL_EDITS to the Agent file of a fresh translation of a sample.
+    :param sample: The name of a folder in Samples, e.g. 'SIRS'
+    :param tmp: The directory containing the translation's folder
+    """
+    name, _ = SAMPLE_NAMES[sample]
+    agent_file = os.path.join(tmp, name, f'{name}Agent.py')
+    with open(agent_file) as file:
+        code = file.read()
+    for old, new in MANUAL_EDITS.get(sample, ()):
+        if old not in code:
+            raise ValueError(f'{sample}: the manual edit of {old!r} no longer applies to the translation')
+        code = code.replace(old, new)
+    with open(agent_file, 'w') as file:
+        file.write(code)
+
+
+def _import_translation(sample, tmp, groups=None):
+    """
+    Imports the Model class of a translation of a sample in a temporary directory, after replacing its Groups JSON
+    file with one from the stored translation (so all models start from the same population).
+    :param sample: The name of a folder in Samples, e.g. 'SIRS'
+    :param tmp: The directory containing the translation's folder
+    :param groups: The name of a Groups JSON file in the stored translation's folder (or the path of any other), or
+                   None for the usual one
+    :return: The Model class
+    """
+    name, folder = SAMPLE_NAMES[sample]
+    # give each translation a unique package name so several can be imported side by side
+    package = f'{name}_bench_{next(_translations)}'
+    shutil.move(os.path.join(tmp, name), os.path.join(tmp, package))
+    target = f'{name}Groups.json'
+    shutil.copy(os.path.join(SAMPLES, sample, folder, groups or target), os.path.join(tmp, package, target))
+
+    sys.path.insert(0, tmp)
+    module = importlib.import_module(f'{package}.{name}Model')
+    return getattr(module, f'{name}Model')
+
+
+def time_steps(model_class, steps, **kwargs):
+    """
+    Builds a model and times its steps.
+    :param model_class: A generated Model class
+    :param steps: The number of steps to run
+    :param kwargs: Extra keyword arguments for the model's constructor
+    :return: A tuple of (seconds spent constructing the model, seconds spent stepping it)
+    """
+    cwd = os.getcwd()  # generated models change the working directory
+    try:
+        t0 = time.perf_counter()
+        model = model_class(datacollector=DataCollector(), **kwargs)
+        t1 = time.perf_counter()
+        for _ in range(steps):
+            model.step()
+        t2 = time.perf_counter()
+    finally:
+        os.chdir(cwd)
+    return t1 - t0, t2 - t1
+
+
+def compare(title, baseline, candidate, steps, trials=3):
+    """
+    Prints the best-of-`trials` construction and stepping times of two Model classes.
+    :param title: A heading for the comparison
+    :param baseline: The Model class to compare against
+    :param candidate: The Model class being measured
+    :param steps: The number of steps to run each model for
+    :param trials: The number of times each model is built and run
+    """
+    base = [time_steps(baseline, steps) for _ in range(trials)]
+    cand = [time_steps(candidate, steps) for _ in range(trials)]
+    base_init, base_step = min(t[0] for t in base), min(t[1] for t in base)
+    cand_init, cand_step = min(t[0] for t in cand), min(t[1] for t in cand)
+    print(f'{title} ({steps} steps, best of {trials})')
+    print(f'    construction: {base_init:9.3f}s -> {cand_init:9.3f}s  ({base_init / cand_init:6.2f}x)')
+    print(f'    stepping:     {base_step:9.3f}s -> {cand_step:9.3f}s  ({base_step / cand_step:6.2f}x)')
+
+
+# ------------------------------------------------- BENCHMARKS -------------------------------------------------
+
+
+def bench_matches_qry():
+    """Compiled GroupQry predicates against the stored translations' dictionary-building matches_qry."""
+    compare('SIRS', stored_model('SIRS'), translate('SIRS'), steps=48)
+    compare('Segregation', stored_model('Segregation'), translate('Segregation'), steps=20)
+
+
+def bench_shared_rules():
+    """Model construction with one shared instance of each rule against one rule instance per agent."""
+    compare('Migration', stored_model('Migration'), translate('Migration'), steps=1)
+    compare('Allegheny_Flu', stored_model('Allegheny_Flu'), translate('Allegheny_Flu'), steps=1)
+
+
+def bench_identifiers():
+    """Precomputed identifier table against calling make_python_identifier on every attribute access."""
+    compare('Migration', stored_model('Migration'), translate('Migration'), steps=48)
+    compare('Allegheny_Flu', stored_model('Allegheny_Flu'), translate('Allegheny_Flu'), steps=10)
+
+
+def bench_site_refs():
+    """Relations held as interned SiteRefs against testing every written value for membership in the grid's nodes."""
+    compare('Allegheny_Flu', stored_model('Allegheny_Flu'), translate('Allegheny_Flu'), steps=10)
+
+
+def bench_staging():
+    """One model-wide staging buffer, committed after all agents step, against each agent advancing its own."""
+    compare('SIRS', stored_model('SIRS'), translate('SIRS'), steps=48)
+    compare('Migration', stored_model('Migration'), translate('Migration'), steps=48)
+
+
+def bench_construction():
+    """Time to first step with agents cloned from one prototype per group, on the full Allegheny population."""
+    groups = 'Allegheny_FluGroups_ORIGINAL.json'
+    compare('Allegheny_Flu (full population)', stored_model('Allegheny_Flu', groups),
+            translate('Allegheny_Flu', groups), steps=1, trials=1)
+
+
+def scaled_groups(sample, factor):
+    """
+    Writes a copy of a sample's stored Groups JSON file with the mass of every group multiplied by factor.
+    :param sample: The name of a folder in Samples, e.g. 'SIRS'
+    :param factor: The number to multiply each group's mass by
+    :return: The path of the new Groups JSON file
+    """
+    name, folder = SAMPLE_NAMES[sample]
+    with open(os.path.join(SAMPLES, sample, folder, f'{name}Groups.json')) as file:
+        groups = json.load(file)
+    for group in groups:
+        group['m'] = round(group['m'] * factor)
+    path = os.path.join(tempfile.mkdtemp(prefix='pram2mesa_bench_'), f'{name}Groups.json')
+    with open(path, 'w') as file:
+        json.dump(groups, file)
+    return path
+
+
+def time_mass_step(model_class, steps):
+    """
+    Builds a model and times its steps, each preceded by a call to get_mass for every agent, as made by a rule that
+    calls group.get_mass().
+    :param model_class: A generated Model class
+    :param steps: The number of steps to run
+    :return: A tuple of (number of agents, seconds per step)
+    """
+    cwd = os.getcwd()
+    try:
+        model = model_class(datacollector=DataCollector())
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            for a in list(model.schedule.agents):
+                model.get_mass(a)
+            model.step()
+        t1 = time.perf_counter()
+    finally:
+        os.chdir(cwd)
+    return len(model.schedule.agents), (t1 - t0) / steps
+
+
+def bench_state_counts():
+    """get_mass(agent) answered from counts of agents by state against comparing the agent with every other agent."""
+    print('Migration: seconds per step, with get_mass(agent) called for every agent')
+    for factor in (0.5, 1, 2, 4):
+        groups = scaled_groups('Migration', factor)
+        n, base = time_mass_step(stored_model('Migration', groups), steps=2)
+        _, cand = time_mass_step(translate('Migration', groups), steps=2)
+        print(f'    {n:6} agents  {base:9.3f}s -> {cand:9.3f}s  ({base / cand:7.2f}x)')
+
+
+def _getattr_get(agent, key, default=None):
+    """The previous implementation of Agent.get"""
+    return getattr(agent, key, default)
+
+
+def bench_get():
+    """Agent.get through the table of known names against its previous implementation, getattr with a default."""
+    print('Migration: ns per call of agent.get(key), previous -> current')
+    for layout, options in (('default', {}), ('slots', {'slots': True}), ('shared', {'shared_states': True})):
+        model_class = translate('Migration', **options)
+        cwd = os.getcwd()
+        try:
+            agent = model_class(datacollector=DataCollector()).schedule.agents[0]
+        finally:
+            os.chdir(cwd)
+        # both bound to the agent, so that each call pays for the same method lookup
+        old_get, new_get = _getattr_get.__get__(agent), agent.get
+        for kind, key in (('hit', 'is_migrating'), ('miss', '__void__')):
+            # the best of several repeats, each of many calls
+            old = min(timeit.repeat(lambda: old_get(key), number=100000, repeat=5)) * 1e4
+            new = min(timeit.repeat(lambda: new_get(key), number=100000, repeat=5)) * 1e4
+            print(f'    {layout:8} {kind:5} {old:8.0f} -> {new:8.0f}  ({old / new:5.2f}x)')
+
+
+def bench_has_attr():
+    """has_attr and has_rel calls with literal arguments translated into direct comparisons against calls of the
+    generic methods."""
+    generic = translate('Allegheny_Flu', specialize=False)
+    specialized = translate('Allegheny_Flu')
+    compare('Allegheny_Flu', generic, specialized, steps=10)
+
+    # the checks made by FluLocationRule, one at a time
+    cwd = os.getcwd()
+    try:
+        group = specialized(datacollector=DataCollector()).schedule.agents[0]
+    finally:
+        os.chdir(cwd)
+    namespace = {'group': group, '_MISSING': sys.modules[type(group).__module__]._MISSING}
+    checks = [("group.has_attr({'flu': 'r'})", "group.get('flu', _MISSING) == 'r'"),
+              ("group.has_attr({'flu': 'i', 'income_level': 'l'})",
+               "group.get('flu', _MISSING) == 'i' and group.get('income_level', _MISSING) == 'l'")]
+    print('    ns per check, generic -> specialized')
+    for old_check, new_check in checks:
+        old = min(timeit.repeat(old_check, globals=namespace, number=100000, repeat=5)) * 1e4
+        new = min(timeit.repeat(new_check, globals=namespace, number=100000, repeat=5)) * 1e4
+        print(f'    {old_check:50} {old:8.0f} -> {new:8.0f}  ({old / new:5.2f}x)')
+
+
+def bench_fused_step():
+    """One step function checking every rule inline against calling each rule's __call__ in turn."""
+    for sample, steps in (('Migration', 48), ('Allegheny_Flu', 10)):
+        per_rule = translate(sample, fused_step=False)
+        compare(sample, per_rule, translate(sample), steps=steps)
+
+
+def bench_active_rules():
+    """Rules' timers worked out once per step by the model against every agent calling each rule to check its timer,
+    over a Migration run reaching well past the end of the conflict rule's window (at 36)."""
+    timers_per_agent = translate('Migration', active_rules=False)
+    compare('Migration', timers_per_agent, translate('Migration'), steps=120)
+
+
+def bench_direct_writes():
+    """Rules changing agents as they step, where no rule can see the changes, against staging every change."""
+    groups = scaled_groups('SIRS', 10)
+    staged = translate('SIRS', groups, direct_writes=False)
+    compare('SIRS (10x population)', staged, translate('SIRS', groups), steps=48)
+
+
+def bench_sparse_activation():
+    """Agents no rule can apply to parked until they change against stepping every agent every step, over a Migration
+    run in which agents settle and stop matching any rule once the conflict rule's window closes (at 36)."""
+    stepped = translate('Migration', sparse=False)
+    compare('Migration', stepped, translate('Migration'), steps=120)
+
+
+def bench_requirements():
+    """Which rules' is_applicable requirements agents meet looked up by the names they hold, against working them out
+    for every agent every step (on SIRS, where every agent holds the required attribute)."""
+    groups = scaled_groups('SIRS', 10)
+    compare('SIRS (10x population)', translate('SIRS', groups, presence=False), translate('SIRS', groups), steps=48)
+
+
+def bench_site_counts():
+    """get_mass of a site answered from counts of the agents at each site by the values they hold, kept up to date as
+    they change, against looking at every agent at the site (Segregation and Allegheny Flu call it for every agent)."""
+    for sample, steps in (('Segregation', 20), ('Allegheny_Flu', 20)):
+        compare(sample, translate(sample, indexes=False), translate(sample), steps=steps)
+
+
+def bench_value_index():
+    """get_groups of the whole model answered from indexes of the agents holding each value of the queried keys, kept
+    up to date as they change, against matching every agent (Migration queries the migrating agents for each of them,
+    as a condition the translation turns into an attribute query)."""
+    groups = scaled_groups('Migration', 10)
+    scanning = translate('Migration', groups, indexes=False)
+    compare('Migration (10x population)', scanning, translate('Migration', groups), steps=48)
+
+    # single queries, on a model whose agents differ by flu, income level and school
+    indexed = translate('Allegheny_Flu', scaled_groups('Allegheny_Flu', 10))
+    cwd = os.getcwd()
+    try:
+        model = indexed(datacollector=DataCollector())
+    finally:
+        os.chdir(cwd)
+    group_qry = sys.modules[type(model.schedule.agents[0]).__module__].GroupQry
+    print(f'    us per get_groups(model, qry) on Allegheny_Flu (10x population, {len(model.schedule.agents)} agents), '
+          'scan -> index')
+    for attr in ({'flu': 'i'}, {'flu': 'i', 'income_level': 'l'}):
+        qry = group_qry(attr=attr)
+        model.get_groups(model, qry)  # index the keys
+        model.indexed = False
+        old = min(timeit.repeat(lambda: model.get_groups(model, qry), number=100, repeat=5)) * 1e4
+        model.indexed = True
+        new = min(timeit.repeat(lambda: model.get_groups(model, qry), number=100, repeat=5)) * 1e4
+        print(f'    {str(attr):40} {old:8.1f} -> {new:8.1f}  ({old / new:6.2f}x)  plan {model.query_plan(qry)}')
+
+
+def bench_query_cache():
+    """Aggregate queries answered once per step, while agents step, against answering every call (Segregation and
+    Allegheny Flu have every agent query the mass of its site, Migration every migrating agent the migrating agents)."""
+    for sample, factor, steps in (('Segregation', 1, 20), ('Allegheny_Flu', 1, 20), ('Migration', 10, 48)):
+        groups = scaled_groups(sample, factor)
+        uncached = translate(sample, groups, query_cache=False)
+        cached = translate(sample, groups)
+        compare(f'{sample} ({factor}x population)', uncached, cached, steps=steps)
+        cwd = os.getcwd()
+        try:
+            model = cached(datacollector=DataCollector())
+            for _ in range(steps):
+                model.step()
+        finally:
+            os.chdir(cwd)
+        queries = model.query_hits + model.query_misses
+        print(f'    {model.query_hits} of {queries} queries answered from the cache '
+              f'({model.query_hits / max(queries, 1):.1%})')
+
+
+def bench_hoisting():
+    """Values the same for every agent computed once per step (and site) against computing them for every agent, with
+    and without the query cache (Allegheny Flu computes infection probabilities from the masses of each site, Migration
+    death probabilities from the rules' parameters and the migrating agents)."""
+    for sample, factor, steps in (('Allegheny_Flu', 1, 20), ('Migration', 10, 48)):
+        groups = scaled_groups(sample, factor)
+        compare(f'{sample} ({factor}x population)', translate(sample, groups, hoisting=False),
+                translate(sample, groups), steps=steps)
+        compare(f'{sample} ({factor}x population, without the query cache)',
+                translate(sample, groups, hoisting=False, query_cache=False),
+                translate(sample, groups, query_cache=False), steps=steps)
+
+
+def agent_memory(model_class, **kwargs):
+    """
+    Measures the memory allocated while building a model, divided among its agents.
+    :param model_class: A generated Model class
+    :param kwargs: Extra keyword arguments for the model's constructor
+    :return: A tuple of (number of agents, bytes allocated per agent)
+    """
+    cwd = os.getcwd()
+    try:
+        model_class(datacollector=DataCollector(), **kwargs)  # warm up caches so they are not counted below
+        tracemalloc.start()
+        model = model_class(datacollector=DataCollector(), **kwargs)
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+    n = len(model.schedule.agents)
+    return n, allocated / n
+
+
+def allocated_dicts(agents):
+    """
+    Counts the agents whose __dict__ has been allocated. CPython only allocates an object's __dict__ when it is first
+    used, so this reads the pointer to it (which is NULL until then) rather than looking the __dict__ up.
+    :param agents: An iterable of agents
+    :return: The number of agents with a __dict__
+    """
+    return sum(ctypes.c_void_p.from_address(id(a) + type(a).__dictoffset__).value is not None for a in agents)
+
+
+def bench_memory():
+    """Memory per agent of the stored, default, __slots__ and shared state Agent layouts, extrapolated to a million
+    agents."""
+    layouts = [('stored', stored_model('Migration')), ('default', translate('Migration')),
+               ('slots', translate('Migration', slots=True)), ('shared', translate('Migration', shared_states=True))]
+    print('Migration')
+    for layout, model_class in layouts:
+        n, per_agent = agent_memory(model_class)
+        print(f'    {layout:8} {per_agent:8.0f} B/agent ({n} agents)  ~{per_agent * 1e6 / 2 ** 30:6.2f} GiB per 1M agents')
+
+    # Mesa's Agent has no __slots__, so slotted agents still have (empty) __dict__ and __weakref__ pointers, and a
+    # __dict__ is only allocated for an agent given a name unknown at translation time
+    slotted = dict(layouts)['slots']
+    cwd = os.getcwd()
+    try:
+        model = slotted(datacollector=DataCollector())
+        built = allocated_dicts(model.schedule.agents)
+        for _ in range(48):
+            model.step()
+    finally:
+        os.chdir(cwd)
+    agents = model.schedule.agents
+    print(f'    slots: {type(agents[0]).__basicsize__} B per agent object, of which 16 B are the __dict__ and '
+          f'__weakref__ pointers of Mesa\'s Agent; agents with a __dict__: {built} once built, '
+          f'{allocated_dicts(agents)} of {len(agents)} after 48 steps')
+
+
+BENCHMARKS = {
+    'matches_qry': bench_matches_qry,
+    'shared_rules': bench_shared_rules,
+    'memory': bench_memory,
+    'identifiers': bench_identifiers,
+    'site_refs': bench_site_refs,
+    'staging': bench_staging,
+    'construction': bench_construction,
+    'state_counts': bench_state_counts,
+    'get': bench_get,
+    'has_attr': bench_has_attr,
+    'fused_step': bench_fused_step,
+    'active_rules': bench_active_rules,
+    'direct_writes': bench_direct_writes,
+    'sparse_activation': bench_sparse_activation,
+    'requirements': bench_requirements,
+    'site_counts': bench_site_counts,
+    'value_index': bench_value_index,
+    'query_cache': bench_query_cache,
+    'hoisting': bench_hoisting
+}
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for b in selected:
+        print(f'==== {b} ====')
+        BENCHMARKS[b]()
@@ -1,5 +1,5 @@
 import textwrap
-from typing import Iterable, Tuple, Set, List
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple, Set, List
 
 from pram.rule import IterAlways, IterPoint, IterInt, IterSet
 from pram.rule import TimeAlways, TimePoint, TimeInt, TimeSet
@@ -11,19 +11,28 @@ import re
 import json
 import iteround
 import inspect
+import dis
 import ast
 import astor
 import autopep8
 import shutil
 from pram2mesa.rule_writer import RuleWriter
 
+# names defined on generated Agent classes (and Mesa's Agent), which agent data can never be stored under as slots
+_AGENT_MEMBERS = frozenset({'step', 'set', 'get', 'delete', 'copy', 'has_attr', 'has_rel', 'matches_qry',
+                            '_protected', '__slots__', '__dict__', '__weakref__'})
 
-# TODO: maybe incorporate is_applicable into __call__ or something
+
+# TODO: only the attributes and relations is_applicable requires are checked (see _requirements); incorporate the rest?
 # TODO: make all dangling random calls go to pop.random
 # TODO: SimRules
 # TODO: more robust handling of inheritance; currently we stop after finding an apply but maybe we should keep going?
-# TODO: make it faster. A large portion of time is spent in get_groups when trying a GroupQry
-def pram2mesa(sim: Simulation, name: str, autopep: bool = True) -> None:
+# TODO: make it faster. A large portion of time is spent in get_groups when trying a GroupQry with conditions
+def pram2mesa(sim: Simulation, name: str, autopep: bool = True, slots: bool = False,
+              shared_states: bool = False, direct_writes: bool = True, active_rules: bool = True,
+              fused_step: bool = True, timers: bool = True, sparse: bool = True, indexes: bool = True,
+              query_cache: bool = True, presence: bool = True, hoisting: bool = True,
+              specialize: bool = True) -> None:
     """
     Converts a PyPRAM simulation object to equivalent Mesa Agent and Model classes.
     This function should be the only function a user must call.
@@ -33,6 +42,31 @@ def pram2mesa(sim: Simulation, name: str, autopep: bool = True) -> None:
     :param autopep: Should the files be run through autopep8 to clean the code?
                     If autopep evaluates to False, autopep8 will not be used.
                     If custom autopep8 usage is desired, set autopep to False and do so manually
+    :param slots: Should the Agent class use a compact __slots__ layout? Every attribute and relation name found in
+                  the groups and in the rules' GroupSplitSpecs gets a slot; any other attributes set at runtime are
+                  kept in the agent's (otherwise unused) __dict__. This considerably reduces memory per agent. (Mesa's
+                  Agent has no __slots__, so agents keep pointers to a __dict__ and to weak references, but a __dict__
+                  is only allocated for an agent given a name unknown at translation time.)
+    :param shared_states: Should agents point to immutable, interned records of their attributes and relations instead
+                          of each holding their own? Agents in the same state then share one record, so memory grows
+                          with the number of distinct states rather than agents, and comparing the states of agents
+                          (as in get_mass) is an identity check. This suits models whose agents are in few distinct
+                          states; every change of state is a lookup in the new state's record. Overrides slots.
+    The following options may each be turned off; the Agent file's header notes the modes chosen and why.
+    :param direct_writes: May rules change agents as they step, when no rule can see it (see _write_mode)?
+    :param active_rules: Should agents only be checked against the rules the model found active in a step, rather than
+                         check every rule's timer themselves (see the Model's schedule_rules)? Needed by fused_step
+    :param fused_step: Should agents check and apply their rules inline (see _fused_step)? Needed by timers and sparse
+    :param timers: May the model run timers as clocks instead of applying them every step (see _timer_rules)?
+    :param sparse: May agents no rule can apply to be left out of steps until they change (see _sparse_rules)?
+    :param indexes: Should the model answer aggregate queries from indexes of agents (see the Model's query_plan)?
+    :param query_cache: Should the model answer each aggregate query once per step (see the Model's _cached)?
+    :param presence: Should the model work out which rules' is_applicable requirements agents meet once for each set of
+                     names they hold, rather than for every agent every step (see the Model's _presence)?
+    :param hoisting: Should rules compute the values that are the same for every agent once per step (see
+                     RuleWriter._hoist)?
+    :param specialize: Should literal has_attr and has_rel calls be turned into comparisons (see
+                       RuleWriter._inline_has)? Timers are only found in rules so specialized
     :return: None. Creates two Python files containing the new Mesa Agent and Model classes and three JSON data files.
              From there, instantiate one of these Models and proceed using standard Mesa tools.
     """
@@ -42,7 +76,7 @@ def pram2mesa(sim: Simulation, name: str, autopep: bool = True) -> None:
     # model relies on make_python_identifier so we pack it up
     shutil.copy(inspect.getsourcefile(mpi), '.')
     group_file, site_file, rule_file = create_json_data(sim, name)
-    rw = RuleWriter()
+    rw = RuleWriter(hoisting=hoisting, specialize=specialize)
 
     new_rules, rule_imports = translate_rules([type(r) for r in sim.rules], rw)
     top_level_rules = [type(r).__name__ for r in sim.rules]
@@ -55,10 +89,32 @@ def pram2mesa(sim: Simulation, name: str, autopep: bool = True) -> None:
         tree.body[0].decorator_list.append('staticmethod')
         group_setup = astor.to_source(rw.visit(tree))
 
+    slot_names = _collect_names(sim, rw) if slots else None
+    categories = _categorical_attributes(sim, rw)
+    guards = _rule_guards(sim)
+    write_mode = _write_mode(sim, rw) if direct_writes else (False, 'turned off (direct_writes=False)')
+    # the fused step reads which rules the model found active, and timers and sparse activation are built on it
+    fused = 'turned off (active_rules=False)' if not active_rules else None if fused_step else \
+        'turned off (fused_step=False)'
+    timer_mode = _timer_rules(sim, rw, guards, categories)
+    if timer_mode[0] and (fused or not timers):
+        timer_mode = ({}, fused or 'turned off (timers=False)')
+    requirements = _requirements(sim, rw)
+    sparse_mode = _sparse_rules(sim, guards, requirements)
+    if sparse_mode[0] is not None and (fused or not sparse):
+        sparse_mode = (None, fused or 'turned off (sparse=False)')
+
     agent_file = create_agent_class(name, new_rules, top_level_rules, rule_file, used_functions=rw.used,
-                                    custom_imports='\n'.join(rule_imports))
+                                    custom_imports='\n'.join(rule_imports), slots=slot_names,
+                                    identifiers=_identifier_table(sim, rw), categories=categories,
+                                    shared_states=shared_states, rule_guards=None if fused else guards,
+                                    active_rules=active_rules,
+                                    write_mode=write_mode, timer_mode=timer_mode, sparse_mode=sparse_mode,
+                                    requirements=requirements, hoisted=rw.hoisted)
     model_file = create_model_class(name, group_file, site_file, agent_file, top_level_rules, group_setup,
-                                    used_functions=rw.used)
+                                    used_functions=rw.used, shared_states=shared_states, timers=bool(timer_mode[0]),
+                                    sparse=sparse_mode[0] is not None, requirements=bool(requirements),
+                                    indexes=indexes, query_cache=query_cache, presence=presence)
 
     if autopep:
         autopep8.fix_file(agent_file, options=autopep8.parse_args(['--in-place', agent_file]))
@@ -83,7 +139,14 @@ def pram2mesa(sim: Simulation, name: str, autopep: bool = True) -> None:
 
 
 def create_agent_class(name: str, rules: Iterable[str], rule_names: Iterable[str], rule_file: str,
-                       custom_imports: str = '', used_functions: Set[str] = None) -> str:
+                       custom_imports: str = '', used_functions: Set[str] = None, slots: Iterable[str] = None,
+                       identifiers: Dict[str, str] = None, categories: Dict[str, List[str]] = None,
+                       shared_states: bool = False, rule_guards: List[Tuple[bool, Any]] = None,
+                       active_rules: bool = True, write_mode: Tuple[bool, str] = (False, ''),
+                       timer_mode: Tuple[Dict[int, Tuple], str] = None,
+                       sparse_mode: Tuple[Optional[List[str]], str] = None,
+                       requirements: Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]] = None,
+                       hoisted: Dict[str, List[Tuple[str, Tuple[str, ...], bool]]] = None) -> str:
     """
     Creates a Python file containing code for the custom Agent class.
     :param name: The name from which the filename will be derived
@@ -92,25 +155,490 @@ def create_agent_class(name: str, rules: Iterable[str], rule_names: Iterable[str
     :param rule_file: A string containing the filename of the JSON Rule data
     :param custom_imports: Non-default import statements that should be included
     :param used_functions: A set of custom functions that must be added. This is derived in rule processing
+    :param slots: Attribute and relation names to give their own slots in a compact __slots__ layout, or None to keep
+                  all agent data in __dict__
+    :param identifiers: A mapping of attribute and relation names to their python-safe identifiers, precomputed so
+                        that the agents need not call make_python_identifier for them at runtime
+    :param categories: A mapping of the (python-safe) names of categorical attributes to their values known at
+                       translation time. Agents store these attributes as small int codes (see _Categorical)
+    :param shared_states: Should agents hold their data in immutable records shared by all agents in the same state
+                          (see _State)? If so, slots is ignored
+    :param rule_guards: Whether each top-level rule is always applied, and its group_qry key (see _rule_guards), from
+                        which a step function checking every rule inline is built, or None to have step call each
+                        active rule in turn
+    :param active_rules: Whether step only calls the rules the model found active in the step (see the Model's
+                         schedule_rules), rather than every rule, each checking its own timer. Ignored with rule_guards
+    :param write_mode: Whether set and delete should change agents directly instead of staging the changes for the
+                       model's advance, and why (see _write_mode)
+    :param timer_mode: The timers the model schedules instead of applying them every step, by index of their rules, and
+                       why (see _timer_rules). Requires rule_guards
+    :param sparse_mode: How each rule tells whether it applies to an agent, or None if agents are never parked, and why
+                        (see _sparse_rules). Requires rule_guards
+    :param requirements: The attributes and the relations (by python-safe name) each rule's is_applicable requires
+                         agents to hold, by rule class name (see _requirements)
+    :param hoisted: The values each rule computes once per step (or per step and site) rather than for every agent,
+                    by rule class name (see RuleWriter._hoist). Only noted in the file's header
     :return: The filename of the new Python file.
     """
     if not used_functions:
         used_functions = set()
+    if not identifiers:
+        identifiers = {}
+    if not categories:
+        categories = {}
+    if not requirements:
+        requirements = {}
     class_name = f'{name}Agent'
     filename = _make_filename(class_name)
     # \n is not permitted in an f-string expression, so do so beforehand
     rules = '\n'.join(rules)
-    rule_declarations = '\n        '.join([f'self.{r} = {r}(self)' for r in rule_names])
-    rule_calls = '\n        '.join([f'self.{r}()' for r in rule_names])
+    identifier_table = ''.join(f'\n    {k!r}: {v!r},' for k, v in sorted(identifiers.items()))
+    direct_writes, write_reason = write_mode
+    if direct_writes:
+        write_header = 'Writes: direct\n' + textwrap.fill(f'Rules change agents as they step: {write_reason}.', 120)
+        # changes are reported to subscribers one at a time, as advance would report them (see Model.subscribe)
+        # and noted for the model's indexes of agents, if it keeps any (see Model._track)
+        track = '''
+        for changes in model._trackers:
+            changes[self] = None''' if set(RuleWriter.aggregates) & used_functions else ''
+        set_body = f'''
+        model = self.model
+        if model.observers:
+            model._advance_observed(((self, key, value),), ())
+        else:
+            setattr(self, key, value){track}'''
+        delete_body = f'''
+        model = self.model
+        if model.observers:
+            model._advance_observed((), ((self, key),))
+        else:
+            delattr(self, key){track}'''
+    else:
+        write_header = 'Writes: staged\n' + textwrap.fill('Rules stage their changes, which the model makes once every '
+                                                          f'agent has stepped: {write_reason or "the default"}.', 120)
+        set_body = '''
+        self.model.staged_sets.append((self, key, value))'''
+        delete_body = '''
+        self.model.staged_dels[self, key] = None'''
+    timers, timer_reason = timer_mode or ({}, '')
+    if not rule_guards:
+        timers = {}
+    if timers:
+        write_header += '\nTimers: scheduled\n' + textwrap.fill(f'The model runs timers as clocks: {timer_reason}.',
+                                                               120)
+    elif timer_reason:
+        write_header += '\nTimers: stepped\n' + textwrap.fill(f'Timers step their counters every step: {timer_reason}.',
+                                                             120)
+    timed = sorted({name for _, _, _, steps in timers.values() for name, _ in steps})
+    timer_table = ''.join(f'\n    {k!r}: {v!r},' for k, v in sorted(timers.items()))
+    requirement_table = ''.join(f'\n    {k!r}: (frozenset({sorted(attrs)!r}), frozenset({sorted(rels)!r})),'
+                                for k, (attrs, rels) in sorted(requirements.items()))
+    # counters kept as clocks are missing from agents while their timers run, and are read through __getattr__
+    timer_lookup = '''
+        if mod_name in _timed:  # a counter the model keeps as a clock while its timer runs (see Model._defer)
+            model = self.model
+            clock = model.clocks[mod_name].get(self)
+            if clock is not None:
+                since, value, step = clock
+                return value + step * (model.time - since)''' if timers else ''
+    sparse, sparse_reason = sparse_mode or (None, '')
+    if not rule_guards:
+        sparse = None
+    if sparse is not None:
+        write_header += '\nActivation: sparse\n' + textwrap.fill('Agents no rule can apply to are not stepped until '
+                                                                  f'they change: {sparse_reason}.', 120)
+    elif sparse_reason:
+        write_header += '\nActivation: full\n' + textwrap.fill(f'Every agent is stepped every step: {sparse_reason}.',
+                                                                120)
+    if hoisted:
+        kept = '; '.join(f'{rule}.{method} ({", ".join(names)}{" per site" if by_site else ""})'
+                         for rule, runs in sorted(hoisted.items()) for method, names, by_site in runs)
+        write_header += '\nHoisted:\n' + textwrap.fill('Rules compute the values that are the same for every agent '
+                                                        f'once per step: {kept}.', 120)
+    # a change to a parked agent may let a rule apply to it again (see BufferedActivation.park)
+    sparse_wake = '''
+        model = self.model
+        if model is not None and self in model.schedule.dormant:
+            model.schedule.wake(self)''' if sparse is not None else ''
+    attr_filter = '''
+
+def _attr_filter(qry):
+    """Returns a predicate matching agents against a GroupQry's attributes and relations, but not its conditions"""
+    return _compiled_qry(tuple(qry.attr.items()), tuple(qry.rel.items()), (), qry.full)
+''' if sparse is not None else ''
+    if rule_guards:
+        step_body = _fused_step(rule_guards, timers, sparse, [requirements.get(r) for r in rule_names])
+    elif requirements:
+        step_body = '''
+        model = self.model
+        presence = model.presence
+        has_attrs = presence[0].get(self._attr) or model._presence(self._attr, 0)
+        has_rels = presence[1].get(self._rel) or model._presence(self._rel, 1)
+        for rule, active, attrs_held, rels_held in zip(model.rules, model.active_rules, has_attrs, has_rels):
+            if active and attrs_held and rels_held:
+                rule(self)''' if active_rules else '''
+        model = self.model
+        presence = model.presence
+        has_attrs = presence[0].get(self._attr) or model._presence(self._attr, 0)
+        has_rels = presence[1].get(self._rel) or model._presence(self._rel, 1)
+        for rule, attrs_held, rels_held in zip(model.rules, has_attrs, has_rels):
+            if attrs_held and rels_held:
+                rule(self)'''
+    elif not active_rules:
+        step_body = '''
+        for rule in self.model.rules:
+            rule(self)'''
+    else:
+        step_body = '''
+        model = self.model
+        for rule, active in zip(model.rules, model.active_rules):
+            if active:
+                rule(self)'''
+    protected = ('model', 'random', 'source_name', 'unique_id', '_attr', '_rel', 'pos')
+    if shared_states:
+        protected += ('_state',)
+    categories = {k: v for k, v in categories.items() if k not in protected and k not in _AGENT_MEMBERS}
+    if shared_states:
+        # position and source_name are kept in the shared records too, though agents still set them directly
+        layout_declaration = '''_state = _state_of({})
+    pos = _Shared('pos')
+    source_name = _Shared('source_name')'''
+        slot_layout = slot_methods = ''
+        field_lookup = 'return self._state.get(name, default)'
+        code_lookup = 'self._state.get(category.name, _MISSING)'
+        dict_layout = '''
+
+class _State(dict):
+    """
+    An immutable record of the attributes and relations (by python-safe name) of agents in some state. Records are
+    interned (see _state_of), so all agents in the same state share one record. Setting or deleting an attribute moves
+    the agent to another record (see _edit) rather than changing the one it holds.
+    """
+    __slots__ = ('edits', 'signature')
+    __hash__ = object.__hash__
+
+    def __reduce__(self):
+        return _state_of, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+_states = {}
+
+
+def _state_of(values):
+    """
+    Returns the interned record of a dictionary of values, creating it if need be. Records holding unhashable values
+    cannot be interned, so each of those is held by a single agent.
+    """
+    try:
+        key = frozenset(values.items())
+        state = _states.get(key)
+    except TypeError:
+        key = state = None
+    if state is None:
+        state = _State(values)
+        state.edits = {}  # {(key, value): the record this one becomes when key is set to value (_MISSING deletes it)}
+        state.signature = None  # see _signature
+        if key is not None:
+            _states[key] = state
+    return state
+
+
+def _edit(state, key, value):
+    """Returns the record differing from state only in the value of key, which is deleted if value is _MISSING"""
+    try:
+        return state.edits[key, value]
+    except (KeyError, TypeError):
+        values = dict(state)
+        if value is _MISSING:
+            del values[key]
+        else:
+            values[key] = value
+        new = _state_of(values)
+        try:
+            state.edits[key, value] = new
+        except TypeError:
+            pass
+        return new
+
+
+def _signature(agent):
+    """
+    Returns the record of an agent's state without its source_name, which is the same record for all agents with the
+    same attributes and relations (see Model.get_mass)
+    """
+    state = agent._state
+    if state.signature is None:
+        state.signature = _edit(state, 'source_name', _MISSING) if 'source_name' in state else state
+    return state.signature
+
+
+class _Shared:
+    """A data descriptor keeping one of the agent's protected names (such as pos) in its state record"""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        return agent._state.get(self.name)
+
+    def __set__(self, agent, value):
+        _store(agent, self.name, value)
+
+
+def _lookup(agent, key):
+    """Returns the attribute or relation of an agent with the given (python-safe) name, or _MISSING"""
+    return agent._state.get(key, _MISSING)
+
+
+def _store(agent, key, value):
+    """Moves an agent to the state differing from its own only in the value stored under the given name"""
+    agent.__dict__['_state'] = _edit(agent._state, key, value)
+
+
+def _erase(agent, key):
+    """Moves an agent to the state lacking the given name from its own, or raises an AttributeError"""
+    state = agent._state
+    if key not in state:
+        raise AttributeError(key)
+    agent.__dict__['_state'] = _edit(state, key, _MISSING)
+
+
+def _vars(agent):
+    """Returns the (shared, and so never to be modified) record of everything stored on an agent"""
+    return agent._state
+
+
+def _clone_into(target, source):
+    """Turns target into a shallow copy of source, reusing target's object"""
+    stored = target.__dict__
+    stored.clear()
+    stored.update(source.__dict__)
+
+
+def _clones(prototype, n):
+    """Returns n new agents holding the same data as prototype (including its unique_id, which should be replaced)"""
+    cls = type(prototype)
+    state = prototype.__dict__
+    clones = []
+    for _ in range(n):
+        a = cls.__new__(cls)
+        a.__dict__.update(state)
+        clones.append(a)
+    return clones
+
+
+def _assign(agent, key, value):
+    """Sets an agent's attribute or relation with the given (python-safe) name, encoding categorical attributes"""
+    category = _categories.get(key)
+    _store(agent, key, value if category is None else category.encode(value))
+
+
+def _fetch(agent, key):
+    """Gets an agent's attribute or relation with the given (python-safe) name, decoding categorical attributes"""
+    value = agent._state.get(key, _MISSING)
+    if value is _MISSING:
+        return object.__getattribute__(agent, key)
+    category = _categories.get(key)
+    return value if category is None else category.decode(value)
+
+
+def _unassign(agent, key):
+    """Deletes an agent's attribute or relation with the given (python-safe) name"""
+    _erase(agent, key)
+'''
+    elif slots is not None:
+        # 'random' is a property of Mesa's Agent, and names of Agent methods cannot double as slots
+        slots = [p for p in protected if p != 'random'] + sorted(set(slots) - set(protected) - _AGENT_MEMBERS)
+        categories = {k: v for k, v in categories.items() if k in slots}
+        # the codes of categorical attributes are kept in hidden slots, leaving their names to the _Categoricals
+        layout_declaration = f'__slots__ = {tuple(f"_{s}_code" if s in categories else s for s in slots)!r}'
+        # copy.copy restores slots with setattr; bypass the custom __setattr__, as is done when restoring __dict__
+        slot_methods = '''
+    def __setstate__(self, state):
+        dict_state, slot_state = state
+        if dict_state:
+            object.__getattribute__(self, '__dict__').update(dict_state)
+        for name, value in slot_state.items():
+            object.__setattr__(self, name, value)
+'''
+        # with slots, _lookup and _vars need the slot descriptors, so they are defined after the class
+        dict_layout = ''
+        code_lookup = '_lookup(self, category.name)'
+        field_lookup = '''slot = _slots.get(name)
+        if slot is None:
+            return object.__getattribute__(self, '__dict__').get(name, default)
+        try:
+            return slot.__get__(self)
+        except AttributeError:  # an empty slot
+            return default'''
+        slot_layout = f'''
+
+_slots = {{name: getattr({class_name}, name) for name in {class_name}.__slots__}}
+for _name in _categories:
+    _slots[_name] = _slots.pop(f'_{{_name}}_code')
+
+
+def _lookup(agent, key):
+    """Returns the attribute or relation of an agent with the given (python-safe) name, or _MISSING"""
+    slot = _slots.get(key)
+    if slot is None:
+        # names not known at translation time are kept in the agent's __dict__
+        return object.__getattribute__(agent, '__dict__').get(key, _MISSING)
+    try:
+        return slot.__get__(agent)
+    except AttributeError:  # an empty slot
+        return _MISSING
+
+
+def _store(agent, key, value):
+    """Stores a value under the given (python-safe) name of a slot, bypassing the agent's __setattr__"""
+    _slots[key].__set__(agent, value)
+
+
+def _erase(agent, key):
+    """Removes the value stored under the given (python-safe) name of a slot, or raises an AttributeError"""
+    _slots[key].__delete__(agent)
+
+
+def _vars(agent):
+    """Returns a dictionary of everything stored on an agent"""
+    stored = {{name: value for name, value in ((n, _lookup(agent, n)) for n in _slots) if value is not _MISSING}}
+    stored.update(getattr(agent, '__dict__', {{}}))
+    return stored
+
+
+def _signature(agent):
+    """
+    Returns a hashable signature of an agent's attributes and relations (less unique_id and source_name), which is
+    equal for all agents in the same state (see Model.get_mass). Raises a TypeError if the agent holds unhashable values
+    """
+    return frozenset(item for item in _vars(agent).items() if item[0] not in ('unique_id', 'source_name', 'model'))
+
+
+def _clone_into(target, source):
+    """Turns target into a shallow copy of source, reusing target's object"""
+    for name, slot in _slots.items():
+        value = _lookup(source, name)
+        if value is not _MISSING:
+            slot.__set__(target, value)
+        elif _lookup(target, name) is not _MISSING:
+            slot.__delete__(target)
+    overflow = object.__getattribute__(target, '__dict__')
+    overflow.clear()
+    overflow.update(object.__getattribute__(source, '__dict__'))
+
+
+def _clones(prototype, n):
+    """Returns n new agents holding the same data as prototype (including its unique_id, which should be replaced)"""
+    cls = type(prototype)
+    state = [(_slots[name], value) for name, value in _vars(prototype).items() if name in _slots]
+    overflow = object.__getattribute__(prototype, '__dict__')
+    clones = []
+    for _ in range(n):
+        a = cls.__new__(cls)
+        for slot, value in state:
+            slot.__set__(a, value)
+        if overflow:
+            object.__getattribute__(a, '__dict__').update(overflow)
+        clones.append(a)
+    return clones
+
+# agents reach their data through ordinary attribute access (which includes any _Categoricals)
+_assign = object.__setattr__
+_fetch = object.__getattribute__
+_unassign = object.__delattr__
+'''
+    else:
+        layout_declaration = slot_layout = slot_methods = ''
+        field_lookup = 'return self.__dict__.get(name, default)'
+        code_lookup = 'self.__dict__.get(category.name, _MISSING)'
+        dict_layout = '''
+
+def _lookup(agent, key):
+    """Returns the attribute or relation of an agent with the given (python-safe) name, or _MISSING"""
+    return agent.__dict__.get(key, _MISSING)
+
+
+def _store(agent, key, value):
+    """Stores a value under the given (python-safe) name, bypassing the agent's __setattr__"""
+    agent.__dict__[key] = value
+
+
+def _erase(agent, key):
+    """Removes the value stored under the given (python-safe) name, or raises an AttributeError"""
+    try:
+        del agent.__dict__[key]
+    except KeyError:
+        raise AttributeError(key) from None
+
+
+def _vars(agent):
+    """Returns a dictionary of everything stored on an agent"""
+    return agent.__dict__
+
+
+def _signature(agent):
+    """
+    Returns a hashable signature of an agent's attributes and relations (less unique_id and source_name), which is
+    equal for all agents in the same state (see Model.get_mass). Raises a TypeError if the agent holds unhashable values
+    """
+    return frozenset(item for item in _vars(agent).items() if item[0] not in ('unique_id', 'source_name', 'model'))
+
+
+def _clone_into(target, source):
+    """Turns target into a shallow copy of source, reusing target's object"""
+    stored = target.__dict__
+    stored.clear()
+    stored.update(source.__dict__)
+
+
+def _clones(prototype, n):
+    """Returns n new agents holding the same data as prototype (including its unique_id, which should be replaced)"""
+    cls = type(prototype)
+    state = prototype.__dict__
+    clones = []
+    for _ in range(n):
+        a = cls.__new__(cls)
+        a.__dict__.update(state)
+        clones.append(a)
+    return clones
+'''
+        dict_layout += '''
+
+# agents reach their data through ordinary attribute access (which includes any _Categoricals)
+_assign = object.__setattr__
+_fetch = object.__getattribute__
+_unassign = object.__delattr__
+'''
+    # get looks the names agents store data under up directly; position ('@'), protected names and categorical
+    # attributes (whose _Categoricals decode them) are left to getattr
+    fields = {k: v for k, v in identifiers.items()
+              if v not in protected and v not in _AGENT_MEMBERS and v not in categories and v not in timed and k != '@'}
+    field_table = ''.join(f'\n    {k!r}: {v!r},' for k, v in sorted(fields.items()))
+    coded_table = ''.join(f'\n    {k!r}: _categories[{v!r}],' for k, v in sorted(identifiers.items()) if v in categories)
+    category_table = ''.join(f'\n    {k!r}: _Categorical({k!r}, {v!r}),' for k, v in sorted(categories.items()))
+    # each categorical attribute's descriptor is also a class attribute of the same name
+    category_declaration = '\n    '.join(f'{k} = _categories[{k!r}]' for k in sorted(categories))
 
     code = f'''"""
 A custom Agent class for a Mesa simulation.
+{write_header}
 """
 
 from mesa import Agent, Model
 from .make_python_identifier import make_python_identifier as mpi
 from collections import Iterable, namedtuple
 from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Any, List, Dict, Callable
 import copy
 import dill
@@ -121,6 +649,76 @@ import json
 
 rule_file = '{rule_file}'  # This could probably be done better?
 
+# every attribute and relation name known at translation time, mapped to its python-safe identifier
+_identifiers = {{{identifier_table}
+}}
+
+
+# the names in _identifiers that agents store attributes and relations under, for Agent.get
+_fields = {{{field_table}
+}}
+
+
+@lru_cache(maxsize=1024)
+def _mpi(name):
+    return mpi(name)
+
+
+def _ident(name):
+    """
+    Returns the python-safe identifier of an attribute or relation name. Names unknown at translation time are
+    converted with make_python_identifier, the results of which are cached.
+    """
+    try:
+        return _identifiers[name]
+    except KeyError:
+        return _mpi(name)
+
+
+class SiteRef:
+    """
+    An interned handle to a site (a node in the model's NetworkGrid). Exactly one SiteRef exists per site name, and
+    relations (including position) always hold SiteRefs, so an agent tells relations from attributes by type alone.
+    A SiteRef hashes and compares equal to its site's name, so either may be used to look up a node or compare sites.
+    """
+    __slots__ = ('name', 'index')
+    _interned = {{}}
+
+    def __new__(cls, name):
+        ref = cls._interned.get(name)
+        if ref is None:
+            ref = object.__new__(cls)
+            ref.name = name
+            ref.index = len(cls._interned)
+            cls._interned[name] = ref
+        return ref
+
+    def __eq__(self, other):
+        return self is other or self.name == other
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return repr(self.name)
+
+    def __str__(self):
+        return self.name
+
+    def __reduce__(self):
+        return SiteRef, (self.name,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _site(value):
+    """Returns the SiteRef of a site name (or SiteRef), or value itself if it does not name a site"""
+    return SiteRef._interned.get(value, value)
+
 # GroupQry = namedtuple('GroupQry', 'attr rel cond full', defaults=[{{}}, {{}}, [], False])
 @dataclass
 class GroupQry:
@@ -128,26 +726,252 @@ class GroupQry:
     rel: Dict[str, str] = field(default_factory=dict)  # check type of values here
     cond: List[Callable[[Agent], bool]] = field(default_factory=list)
     full: bool = False
+    match: Callable[[Agent], bool] = field(init=False, repr=False, compare=False)
+
     def __post_init__(self):
-        # ensure attributes and relations are valid variable names
-        self.attr = {{mpi(k): v for k, v in self.attr.items()}}
-        self.rel = {{mpi(k): v for k, v in self.rel.items()}}
-    
+        # ensure attributes and relations are valid variable names. Mesa stores position ('@') in `pos`
+        self.attr = {{_ident(k): v for k, v in self.attr.items()}}
+        self.rel = {{('pos' if k == '@' else _ident(k)): v for k, v in self.rel.items()}}
+        # compile the query once here, rather than re-deriving it every time an agent is tested against it
+        self.match = _compiled_qry(tuple(self.attr.items()), tuple(self.rel.items()), tuple(self.cond), self.full)
+
+
+_MISSING = object()
+{dict_layout}
+
+class _Raw:
+    """
+    A value stored under a categorical attribute as it is, having no code (see _Categorical). Raw values are only equal
+    to raw values of the same type, as codes are
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return type(other) is _Raw and type(self.value) is type(other.value) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+class _Categorical:
+    """
+    A data descriptor for an attribute whose values are a few strings: agents store the index (code) of their value in
+    values, and reading the attribute decodes it. Values unknown at translation time are stored as they are, in a _Raw.
+    """
+    __slots__ = ('name', 'values', 'codes')
+
+    def __init__(self, name, values):
+        self.name = name
+        self.values = list(values)
+        # keyed by type too, so that values equal to a known one (such as True and 1) are not read back as it
+        self.codes = {{(type(value), value): code for code, value in enumerate(self.values)}}
+
+    def encode(self, value):
+        """Returns what agents store for a value: its code, or the value in a _Raw if it has none (or is unhashable)"""
+        try:
+            code = self.codes.get((type(value), value))
+        except TypeError:
+            return _Raw(value)
+        return _Raw(value) if code is None else code
+
+    def decode(self, stored):
+        """Returns the value agents store as stored (see encode)"""
+        return stored.value if type(stored) is _Raw else self.values[stored]
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        code = _lookup(agent, self.name)
+        if code is _MISSING:
+            raise AttributeError(f"'{{type(agent).__name__}}' object has no attribute '{{self.name}}'")
+        return self.decode(code)
+
+    def __set__(self, agent, value):
+        _store(agent, self.name, self.encode(value))
+
+    def __delete__(self, agent):
+        _erase(agent, self.name)
+
+
+# the categorical attributes found at translation time, and their known values
+_categories = {{{category_table}
+}}
+
+
+# the names in _identifiers of categorical attributes, for Agent.get
+_coded_fields = {{{coded_table}
+}}
+
+
+# the rules (by index in the model's rules) whose timers the model schedules rather than applying them every step, as
+# {{index: (tested counter, the value it fires at, its step, ((counter, step), ...))}} (see Model._defer)
+_timer_rules = {{{timer_table}
+}}
+# the counters of those timers, which agents are missing while the model keeps them as clocks
+_timed = frozenset({timed!r})
+
+# the attributes and the relations the is_applicable of each rule requires agents to hold, as {{rule class name:
+# (attribute names, relation names)}}, which the model checks before the rule is applied (see Model._presence)
+_requirements = {{{requirement_table}
+}}
+
+
+def _encoded(key, value):
+    """Returns a value as agents store it under the given (python-safe) name, i.e. encoded if it is categorical"""
+    category = _categories.get(key)
+    return value if category is None else category.encode(value)
+
+
+_name_sets = {{}}
+
+
+def _intern(names):
+    """
+    Returns a shared frozenset equal to names. Agents use these for _attr and _rel, so that agents with the same
+    attribute and relation names (usually most of them) share the same sets instead of each holding their own.
+    """
+    return _name_sets.setdefault(names, names)
+
+
+def _window(i):
+    """
+    Compiles a rule's timer into the times at which the rule is applied, as its __call__ checks them.
+    :param i: The rule's i, as stored in its JSON data
+    :return: None if the rule is applied at every time; otherwise a container of the times it is applied at (empty
+             for a timer that cannot be checked, such as an IterSet, which does not survive being stored as JSON)
+    """
+    if not i:
+        return None
+    if isinstance(i, int):
+        return frozenset((i,))
+    if isinstance(i, list):
+        # an interval ending at 0 is open-ended below (see __call__)
+        return range(max(i[0], 0) + 1) if i[1] == 0 else range(i[0], i[1] + 1)
+    if isinstance(i, set):
+        return frozenset(i)
+    return frozenset()
+
+
+def _match_all(agent):
+    return True
+
+
+def _compile_qry(attr, rel, cond, full):
+    """
+    Builds a predicate function for a GroupQry. Only the queried keys are checked, each with a single lookup (see
+    _lookup).
+    :param attr: A tuple of (name, value) pairs of attributes. Values of categorical attributes are encoded here
+    :param rel: A tuple of (name, value) pairs of relations, with '@' already normalized to 'pos'
+    :param cond: A tuple of functions taking an agent and returning a bool
+    :param full: Whether the attributes and relations must be an exact match
+    :return: A function taking an agent and returning True if it matches the query
+    """
+    attr = tuple((k, _encoded(k, v)) for k, v in attr)
+    checks = attr + rel
+    if full:
+        attr_keys = frozenset(k for k, _ in attr)
+        rel_keys = frozenset(k for k, _ in rel)
+
+        def match(agent):
+            if agent._attr != attr_keys or agent._rel != rel_keys:
+                return False
+            return all(_lookup(agent, k) == v for k, v in checks) and all(fn(agent) for fn in cond)
+    elif not checks and not cond:
+        match = _match_all
+    elif len(checks) == 1 and not cond:
+        (key, value), = checks
+
+        def match(agent):
+            return _lookup(agent, key) == value
+    else:
+        def match(agent):
+            return all(_lookup(agent, k) == v for k, v in checks) and all(fn(agent) for fn in cond)
+
+    return match
+
+
+class _QryArgs:
+    """
+    The arguments of _compile_qry, hashed and compared by a key equal for identical queries (conditions being compared
+    as in _qry_key). Raises a TypeError (or a ValueError) if they hold unhashable values
+    """
+    __slots__ = ('args', 'key', 'hash')
+
+    def __init__(self, attr, rel, cond, full):
+        self.args = (attr, rel, cond, full)
+        self.key = (attr, rel, tuple(_cond_key(fn) for fn in cond), full)
+        self.hash = hash(self.key)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+@lru_cache(maxsize=1024)
+def _compiled(qry_args):
+    return _compile_qry(*qry_args.args)
+
+
+def _compiled_qry(attr, rel, cond, full):
+    """
+    Returns the predicate _compile_qry builds for a query, shared by identical queries so that the lambdas of a query
+    rebuilt in every call of a rule's apply do not each compile it anew. The most recently used 1024 are kept; queries
+    holding unhashable values are compiled every time
+    """
+    try:
+        qry_args = _QryArgs(attr, rel, cond, full)
+    except (TypeError, ValueError):
+        return _compile_qry(attr, rel, cond, full)
+    return _compiled(qry_args)
+
+
+def _cond_key(fn):
+    """Returns a key equal for conditions of the same code over equal captured values and defaults"""
+    if not hasattr(fn, '__code__'):
+        return fn
+    return fn.__code__, fn.__defaults__, tuple(cell.cell_contents for cell in fn.__closure__ or ())
+
+
+def _qry_key(qry):
+    """
+    Returns a hashable key equal for GroupQrys that match the same agents: the same attributes and relations (in any
+    order) and equal conditions (see _cond_key). Raises a TypeError (or a ValueError, for a condition capturing an
+    unset variable) if qry holds unhashable values
+    """
+    key = (frozenset(qry.attr.items()), frozenset(qry.rel.items()), tuple(_cond_key(fn) for fn in qry.cond), qry.full)
+    hash(key)
+    return key
+
+
+def _count_key(agent, keys, full):
+    """
+    Returns what the model counts an agent under for queries of the given keys made of sites (see Model._site_mass):
+    the values it holds under them, and for a full query, also the names of the attributes and relations it holds.
+    Raises a TypeError if the result is unhashable
+    """
+    values = tuple(_lookup(agent, key) for key in keys)
+    counted = (agent._attr, agent._rel, values) if full else values
+    hash(counted)
+    return counted
+{attr_filter}
 
 class {class_name}(Agent):
 
-    _protected = ('model', 'random', 'source_name', 'unique_id', '_attr', '_rel', 'pos', 'set_dict', 'del_set',
-                  {', '.join([f"'{r}'" for r in rule_names])})  # TODO: should pos actually be in here
-    
+    _protected = {protected!r}  # TODO: should pos actually be in here
+    {layout_declaration}
+    {category_declaration}
+    {slot_methods}
     # def __init__(self, unique_id, model):
     def __init__(self, unique_id, model, attr, rel):
         # Mesa generally holds Agent data (including locations) as attributes, not dictionary entries.
         # as such, we only store names of attributes and relations in different sets for compatibility with some
         # specific PRAM functions like get_attrs and get_rels. If needed, attribute values are retrieved lazily
-        self._attr = set()
-        self._rel = set()
-        self.set_dict = {{}}
-        self.del_set = set()
+        self._attr = self._rel = _intern(frozenset())
         super().__init__(unique_id, model)
         # making identifiers should be handled in translation now
         # self.namespace = {{}}  # for make_python_identifier
@@ -161,7 +985,7 @@ class {class_name}(Agent):
             s = self.model.site_hashes[value]
             if key == '@':
                 self.model.grid.place_agent(self, s)
-                self._rel.add('pos')
+                self._rel = _intern(self._rel | {{'pos'}})
             else:
                 setattr(self, key, s)
             # else:
@@ -170,8 +994,7 @@ class {class_name}(Agent):
             #     # self._rel.add(id)
             #     setattr(self, key, s)
             #     self._rel.add(key)
-        # make (callable) instances of each of our rules
-        {rule_declarations}
+        # rules are not stored per agent; the model holds one shared instance of each (see step)
 
     # we customize __setattr__ in order to:
     # - keep track of attributes vs relations, mostly for pram compatibility.
@@ -182,30 +1005,28 @@ class {class_name}(Agent):
         if name in {class_name}._protected:
             object.__setattr__(self, name, value)
             return
-
-        name = mpi(name)
+{sparse_wake}
+        name = _ident(name)
         
-        if value in self.model.grid.G.nodes:
-        # if value in self.model.site_hashes | self.model.grid.G.nodes:
-        #     try:
-        #         value = self.model.site_hashes[value]
-        #     except KeyError:
-        #         pass
+        # relations always hold SiteRefs (see _site)
+        if isinstance(value, SiteRef):
             if name == '_at_sign':
                 self.model.grid.move_agent(self, value)
                 # self._rel.add('pos')
             else:
-                object.__setattr__(self, name, value)
-                self._rel.add(name)
+                _assign(self, name, value)
+                if name not in self._rel:
+                    self._rel = _intern(self._rel | {{name}})
             return
 
-        object.__setattr__(self, name, value)
-        self._attr.add(name)
+        _assign(self, name, value)
+        if name not in self._attr:
+            self._attr = _intern(self._attr | {{name}})
         
     # we also customize __getattr__ to use make_python_identifier where needed and for position lookups
     # we do not use __getattribute__; we only want to change behavior for non-safe/non-found attributes, and '@' (pos)
     def __getattr__(self, name):
-        mod_name = mpi(name)
+        mod_name = _ident(name)
         # if name == mod_name:
         #     raise AttributeError(f"'{{type(self).__name__}}' object has no attribute '{{mod_name}}'")
         if mod_name == '_at_sign':
@@ -214,75 +1035,74 @@ class {class_name}(Agent):
         # all we do to fix broken lookups is look for positional calls and unsafe names.
         # if calling mpi fixes a name, this sends it back to __getattribute__ and we continue as normal.
         # if not, it will get caught by the first if clause above (this may be an inefficient way to do this)
-        # return getattr(self, mod_name)
-        return object.__getattribute__(self, mod_name)
+        # return getattr(self, mod_name){timer_lookup}
+        return _fetch(self, mod_name)
         
     # we similarly customize __delattr__ to use make_python_identifier and to remove agents from the grid
-    def __delattr__(self, name):
+    def __delattr__(self, name):{sparse_wake}
         try:
-            object.__delattr__(self, name)
+            _unassign(self, name)
         except AttributeError:
-            name = mpi(name)
+            name = _ident(name)
             if name == 'at_sign':
                 self.grid._remove_agent(self, self.pos)
                 object.__delattr__(self, 'pos')
             else:
-                object.__delattr__(self, name)
+                _unassign(self, name)
         
-        # purge from _attr or _rel (we just blindly guess until we either get it or don't)
-        try:
-            self._attr.remove(name)
-        except KeyError:
-            try:
-                self._rel.remove(name)
-            except KeyError:
-                pass
+        # purge from _attr or _rel
+        if name in self._attr:
+            self._attr = _intern(self._attr - {{name}})
+        elif name in self._rel:
+            self._rel = _intern(self._rel - {{name}})
                 
 
-    # models use SimultaneousActivation.
-    # The step function calls all of the rules, which will stage attribute changes.
-    # The advance function makes those changes.
-    def step(self): 
-        {rule_calls}
-
-    def advance(self):
-        for key, value in self.set_dict.items():
-            setattr(self, key, value)
-        self.set_dict.clear()
-
-        while self.del_set:
-            delattr(self, self.del_set.pop())
+    # models use a form of SimultaneousActivation.
+    # The step function calls all of the model's rules on this agent, which will stage attribute changes in the model.
+    # The model's advance function then makes the changes staged by all agents.
+    def step(self):{step_body}
 
     def set(self, key, value):
         """
         Use this function instead of directly setting an attribute in a rule.
-        """
-        self.set_dict[key] = value
+        """{set_body}
+        if key == '__void__' and value:
+            self.model.void_queue[self] = None
 
     def get(self, key, default=None):
         """
         Alias for getattr(self, key, default).
         (Note however that this will return None instead of throw an AttributeError)
+        Names known at translation time (see _fields) are looked up directly, without raising an AttributeError.
         """
-        return getattr(self, key, default)
+        name = _fields.get(key)
+        if name is None:
+            category = _coded_fields.get(key)
+            if category is None:
+                return getattr(self, key, default)
+            code = {code_lookup}
+            return default if code is _MISSING else category.decode(code)
+        {field_lookup}
 
     def delete(self, key):
         """
         Use this function instead of directly deleting an attribute in a rule.
-        """
-        self.del_set.add(key)
+        """{delete_body}
 
 '''
     if 'copy' in used_functions:
         code += '''
     def copy(self, is_deep=False):
         """
-        Copies an agent, but explicitly *does not* add them to the scheduler or grid.
-        To do so, call add_vita_group (in PRAM).
+        Copies an agent (reusing a removed one for shallow copies; see Model.reuse_agent), but explicitly *does not*
+        add them to the scheduler or grid. To do so, call add_vita_group (in PRAM).
         NOTE: deep copies are NOT RECOMMENDED.
         """
-        
-        new = copy.copy(self) if not is_deep else copy.deepcopy(self)
+        new = self.model.reuse_agent() if not is_deep else None
+        if new is not None:
+            _clone_into(new, self)
+        else:
+            new = copy.copy(self) if not is_deep else copy.deepcopy(self)
         new.unique_id = None
         new.model = None
         return new
@@ -295,18 +1115,18 @@ class {class_name}(Agent):
         Determines if this agent matches a specified query of attributes.
         :param qry: A string, iterable, or mapping of attributes.
         :return: True if... (False otherwise)
-            * qry is a string and is a key in this agent's __dict__
-            * qry is an iterable and all items in it are keys in this agent's __dict__
-            * qry is a mapping and all items in it are in this agent's __dict__
+            * qry is a string and is the name of something stored on this agent
+            * qry is an iterable and all items in it are names of things stored on this agent
+            * qry is a mapping and all items in it are stored on this agent
             Note: these checks are done after making the string, iterable items, or keys into python-safe names.
         """
         if isinstance(qry, dict):
-            qry = {mpi(key): value for key, value in qry.items()}
-            return qry.items() <= self.__dict__.items()
+            stored = ((_ident(key), value) for key, value in qry.items())
+            return all(_lookup(self, key) == _encoded(key, value) for key, value in stored)
         elif isinstance(qry, str):  # place above iterable check, since str is iterable
-            return mpi(qry) in self.__dict__.keys()
+            return _lookup(self, _ident(qry)) is not _MISSING
         elif isinstance(qry, Iterable):
-            return all(mpi(i) in self.__dict__.keys() for i in qry)
+            return all(_lookup(self, _ident(i)) is not _MISSING for i in qry)
             
         raise TypeError(f'qry passed to has_attr should be of type dict, str, or Iterable, but was {type(qry)} instead')
 '''
@@ -318,18 +1138,18 @@ class {class_name}(Agent):
         Currently, this is the same function as has_attr.
         :param qry: A string, iterable, or mapping of relations.
         :return: True if... (False otherwise)
-            * qry is a string and is a key in this agent's __dict__
-            * qry is an iterable and all items in it are keys in this agent's __dict__
-            * qry is a mapping and all items in it are in this agent's __dict__
+            * qry is a string and is the name of something stored on this agent
+            * qry is an iterable and all items in it are names of things stored on this agent
+            * qry is a mapping and all items in it are stored on this agent
             Note: these checks are done after making the string, iterable items, or keys into python-safe names.
         """
         if isinstance(qry, dict):
-            qry = {mpi(key): value for key, value in qry}
-            return qry.items() <= self.__dict__.items()
+            stored = ((_ident(key), value) for key, value in qry.items())
+            return all(_lookup(self, key) == _encoded(key, value) for key, value in stored)
         elif isinstance(qry, str):  # place above iterable check, since str is iterable
-            return mpi(qry) in self.__dict__.keys()
+            return _lookup(self, _ident(qry)) is not _MISSING
         elif isinstance(qry, Iterable):
-            return all(mpi(i) in self.__dict__.keys() for i in qry)
+            return all(_lookup(self, _ident(i)) is not _MISSING for i in qry)
             
         raise TypeError(f'qry passed to has_rel should be of type dict, str, or Iterable, but was {type(qry)} instead')
 '''
@@ -346,23 +1166,11 @@ class {class_name}(Agent):
         :param qry: A GroupQry namedtuple
         :return: True if the agent matches the qry; False otherwise
         """
-        
-        if not qry:
-            return True
-        # the code below is REALLY PAINFUL... replacing it with 'return True` makes the code run like 20x faster
-        if qry.rel.get('@'):
-            qry.rel['pos'] = qry.rel.pop('@')
-        
-        if qry.full:
-            return qry.attr.items() == {k: self.get(k) for k in self._attr}.items() \\
-                   and qry.rel.items() == {k: self.get(k) for k in self._rel}.items() \\
-                   and all([fn(self) for fn in qry.cond])
-        else:
-            return qry.attr.items() <= {k: self.get(k) for k in self._attr}.items() \\
-                   and qry.rel.items() <= {k: self.get(k) for k in self._rel}.items() \\
-                   and all([fn(self) for fn in qry.cond])
+        # the query was compiled into a predicate when it was created; see _compile_qry
+        return not qry or qry.match(self)
 '''
 
+    code += slot_layout
     code += rules
 
     # this is pretty lazy but a good safeguard
@@ -375,17 +1183,29 @@ class {class_name}(Agent):
 
 
 def create_model_class(name: str, group_file: str, site_file: str, agent_file: str, stage_list: Iterable[str],
-                       group_setup: str = '', custom_imports: str = '', used_functions: Set[str] = None) -> str:
+                       group_setup: str = '', custom_imports: str = '', used_functions: Set[str] = None,
+                       shared_states: bool = False, timers: bool = False, sparse: bool = False,
+                       requirements: bool = False, indexes: bool = True, query_cache: bool = True,
+                       presence: bool = True) -> str:
     """
     Creates a Python file containing code for the custom Model class.
     :param name: The name from which the filename will be derived
     :param group_file: The name of the JSON file storing Group data from the PRAM
     :param site_file: The name of the JSON file storing Site data from the PRAM
     :param agent_file: The name of the corresponding Mesa Agent file
-    :param stage_list: A list of stage functions for the schedule
+    :param stage_list: A list of class names of the top-level rules, in the order they are applied
     :param group_setup: The definition of a pre-run group setup rule, or None
     :param custom_imports: Non-default import statements that should be included
     :param used_functions: A set of custom functions that must be added. This is derived in rule processing
+    :param shared_states: Whether the agents hold their data in shared state records (see create_agent_class)
+    :param timers: Whether the Agent class has timers for the model to schedule (see _timer_rules)
+    :param sparse: Whether agents park themselves when no rule can apply to them (see _sparse_rules)
+    :param requirements: Whether any rule's is_applicable requires agents to hold attributes or relations (see
+                         _requirements)
+    :param indexes: Whether the model answers aggregate queries from its indexes of agents, at first (see query_plan)
+    :param query_cache: Whether the model answers each aggregate query once per step (see _cached)
+    :param presence: Whether the model keeps which rules' requirements agents meet by the names they hold (see
+                     _presence)
     :return: The filename of the new Python file.
     """
     if not used_functions:
@@ -393,42 +1213,343 @@ def create_model_class(name: str, group_file: str, site_file: str, agent_file: s
 
     class_name = f'{name}Model'
     agent_module = agent_file[:-3]  # strip .py
+    # agents may keep data in slots, so get_mass compares what _vars finds rather than their __dict__
+    # removed agents are only worth keeping if they can be reused by copies
+    retire = '''
+                if len(self.agent_pool) < self.pool_size:
+                    self.agent_pool.append(a)''' if 'copy' in used_functions else ''
+    # get_mass counts agents by state; the counts are only set up if needed (see _count_states)
+    agent_helpers = state_index = ''
+    if {'get_mass', 'get_mass_prop', 'get_mass_and_prop'} & used_functions:
+        agent_helpers = ', _count_key, _encoded, _signature, _vars'
+        state_index = '''
+        # the number of agents with each signature, and the signature each agent was counted under (see get_mass)
+        self.state_counts = None
+        self.agent_states = {}
+        self.changed_agents = {}
+        # the number of agents at each site holding each combination of values of the keys queried of sites, and what
+        # each agent was counted under, as {(keys, full): ({(site, values): count}, {agent: (site, values)})}, or None
+        # until a site is queried (see _site_mass)
+        self.site_counts = None
+        self.site_changes = {}'''
+    # get_groups finds the agents of the model matching a query from indexes of the values agents hold (see query_plan)
+    # aggregate queries are cached while agents step, as they cannot change until advance (see _cached)
+    value_index = cache_start = cache_end = ''
+    if {'get_groups', 'get_mass', 'get_mass_prop', 'get_mass_and_prop', 'get_group', 'get_groups_mass',
+            'get_groups_mass_prop', 'get_groups_mass_and_prop'} & used_functions:
+        agent_helpers += ', _MISSING, _encoded, _lookup, _qry_key'
+        if query_cache:
+            cache_start = '''
+        self.query_cache = {}'''
+            cache_end = '''
+        self.query_cache = None'''
+        value_index = f'''
+        # whether aggregate queries are answered from the indexes and counts below, rather than by looking at agents
+        self.indexed = {indexes}''' + '''
+        # the results of aggregate queries of sites or the whole model made while agents step, as {(kind, target, query
+        # key): result}, or None between steps (see _cached), and how many queries were answered from it or not
+        self.query_cache = None
+        self.query_hits = 0
+        self.query_misses = 0
+        # the unique_ids of the agents holding each value of each attribute and relation queried of the whole model, and
+        # what each agent was indexed under, as {key: ({value: {unique_id}}, {agent: (unique_id, value)})}, or None
+        # until the model is queried (see query_plan)
+        self.value_index = None
+        self.value_changes = {}'''
+    if {'has_attr', 'ha', 'has_rel', 'hr'} & used_functions:
+        # translated calls of these with literal arguments compare agents' data against _MISSING (e.g. in group setup)
+        agent_helpers += ', _MISSING'
+    # running timers keep their agents' counters as clocks, which are put back when they fire (see _defer)
+    timer_import = timer_state = timer_wake = timer_stop = timer_cleanup = timer_park = settle = ''
+    if timers:
+        agent_helpers += ', _assign, _erase, _lookup, _timer_rules, _timed'
+        timer_import = 'import heapq\n'
+        timer_state = '''
+        # the counters of agents whose timers are running, kept as {counter: {agent: (time, value then, step)}}, and the
+        # times the timers fire at, as a heap of (time, unique_id, index of the rule, agent); see _defer
+        self.clocks = {name: {} for name in _timed}
+        self.timer_events = []'''
+        timer_wake = '''
+        if self.timer_events:
+            self._wake_timers()'''
+        timer_stop = '''
+        self._stop_timers()'''
+        timer_cleanup = '''
+                for clock in self.clocks.values():
+                    clock.pop(a, None)'''
+        # aggregate queries read what agents hold, so the counters kept as clocks are first put back (see _settle)
+        settle = '''
+        self._settle(qry)'''
+        if sparse:
+            timer_park = '''
+        self.schedule.wake(agent)'''
+    timer_methods = f'''
+    # ------------------------- TIMERS -------------------------
+
+    def _defer(self, agent, k):
+        """
+        Starts the timer of the k-th rule for an agent, keeping its counters as clocks (read by the agent's __getattr__)
+        until the tested counter reaches the value the timer fires at (see _wake_timers). No timer is started while
+        changes are observed (see subscribe), since every step of the counters must then be reported.
+        :param agent: An agent matching the rule's group_qry
+        :param k: The index of the rule in rules
+        :return: True if the timer was started; False if the rule should be applied as usual
+        """
+        if self.observers:
+            return False
+        counter, fires_at, step, steps = _timer_rules[k]
+        values = [_lookup(agent, name) for name, _ in steps]
+        if any(type(value) is not int for value in values):
+            return False  # the rule deals with missing (or other) values as it would have
+        value = _lookup(agent, counter)
+        if value == fires_at:
+            return False
+        time = self.time
+        for (name, each), start in zip(steps, values):
+            self.clocks[name][agent] = (time, start, each)
+            _erase(agent, name)
+        # the counter reaches the value after (fires_at - value) / step steps, if ever
+        left, off = divmod(fires_at - value, step)
+        if left > 0 and not off:
+            heapq.heappush(self.timer_events, (time + left, agent.unique_id, k, agent))
+        return True
+
+    def _wake_timers(self):
+        """Stops the timers that fire at the current time, so that their rules are applied to their agents again"""
+        events = self.timer_events
+        while events and events[0][0] <= self.time:
+            _, _, k, agent = heapq.heappop(events)
+            self._stop_timer(agent, k)
+
+    def _stop_timer(self, agent, k):
+        """Stores the current values of the counters an agent's running timer of the k-th rule keeps as clocks"""
+        time = self.time
+        for name, _ in _timer_rules[k][3]:
+            clock = self.clocks[name].pop(agent, None)
+            if clock is not None:
+                since, value, step = clock
+                _assign(agent, name, value + step * (time - since)){timer_park}
+        if self._trackers:
+            self._note((agent,))
+
+    def _stop_timers(self):
+        """Stops every running timer (see _defer), storing the current values of its counters"""
+        self.timer_events = []
+        for k, (counter, _, _, _) in _timer_rules.items():
+            for agent in list(self.clocks[counter]):
+                self._stop_timer(agent, k)
+
+    def _settle(self, qry):
+        """
+        Stops every running timer before an aggregate query of the counters kept as clocks is answered, as agents are
+        missing them while their timers run. Rules never make such queries while timers run (see _timer_rules).
+        :param qry: a GroupQry namedtuple
+        """
+        if not _timed.isdisjoint(qry.attr) and any(self.clocks.values()):
+            self._stop_timers()
+''' if timers else ''
+    if sparse:
+        activation = '''class BufferedActivation(SimultaneousActivation):
+    """
+    Steps all agents, then has the model make all staged changes at once. No agent is stepped while no rule is active,
+    and agents that no active rule could apply to park themselves (see park) until they are woken (see wake).
+    """
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.dormant = {}  # parked agents, as {agent: None}
+        self.awake = None  # the agents to step, in the order they were added, or None to find them among all agents
+        self.woken = []  # agents woken or added since the last step, to be merged into awake
+        self.removed = {}  # agents removed since the last step while awake, as {agent: None}
+        self.parked = False  # whether any agent parked itself in the current step
+
+    def step(self):
+        if any(self.model.active_rules):
+            awake = self._awake()
+            self.parked = False
+            for agent in awake:
+                agent.step()
+            if self.parked:
+                dormant = self.dormant
+                self.awake = [agent for agent in awake if agent not in dormant]
+        self.model.advance()
+        self.steps += 1
+        self.time += 1
+
+    def add(self, agent):
+        super().add(agent)
+        if self.awake is not None:
+            self.woken.append(agent)
+
+    def remove(self, agent):
+        super().remove(agent)
+        if agent in self.dormant:
+            del self.dormant[agent]
+        else:
+            self.removed[agent] = None
+
+    def park(self, agent):
+        """Stops stepping an agent that no active rule could apply to, until it is woken (see wake)"""
+        self.dormant[agent] = None
+        self.parked = True
+
+    def wake(self, agent):
+        """Steps a parked agent again from the next step on, as a change to it may let a rule apply to it"""
+        if agent in self.dormant:
+            del self.dormant[agent]
+            self.woken.append(agent)
+
+    def wake_all(self):
+        """Steps every parked agent again from the next step on, as when a rule becomes active"""
+        self.dormant.clear()
+        self.awake = None
+
+    def _awake(self):
+        """Returns the agents to step (those not parked), in the order they were added"""
+        awake = self.awake
+        if awake is None:
+            dormant = self.dormant
+            awake = [agent for agent in self._agents.values() if agent not in dormant]
+        else:
+            if self.removed:
+                removed = self.removed
+                awake = [agent for agent in awake if agent not in removed]
+            if self.woken:
+                agents = self._agents
+                woken = [agent for agent in self.woken if agents.get(agent.unique_id) is agent]  # not removed since
+                # the model numbers agents as it adds them, so ordering them by unique_id keeps the order they were
+                # added in
+                awake = sorted(dict.fromkeys(awake + woken), key=lambda agent: agent.unique_id)
+        self.awake = awake
+        self.woken = []
+        self.removed = {}
+        return awake
+'''
+        # a rule becoming active may apply to agents parked while it was not
+        rule_activation = '''
+        active = tuple(window is None or time in window for window in self.rule_windows)
+        if any(now and not before for now, before in zip(active, self.active_rules)):
+            self.schedule.wake_all()
+        self.active_rules = active'''
+        rule_filters = '''
+        self.rule_filters = [_attr_filter(rule.group_qry) if rule.group_qry else None for rule in self.rules]
+        self.schedule.wake_all()'''
+        agent_helpers += ', _attr_filter'
+        rule_index = '''
+        # the attributes and relations of each rule's group_qry, which parked agents failed (see the Agent's step)
+        self.rule_filters = []'''
+    else:
+        activation = '''class BufferedActivation(SimultaneousActivation):
+    """
+    Steps all agents, which stage their changes in the model, then has the model make all staged changes at once.
+    Unlike SimultaneousActivation, agents that staged nothing are not visited a second time, and no agent is visited
+    at all at a time when no rule is active (see the model's schedule_rules).
+    """
+
+    def step(self):
+        if any(self.model.active_rules):
+            for agent in list(self._agents.values()):
+                agent.step()
+        self.model.advance()
+        self.steps += 1
+        self.time += 1
+'''
+        rule_activation = '''
+        self.active_rules = tuple(window is None or time in window for window in self.rule_windows)'''
+        rule_filters = rule_index = ''
+    # rules are only applied to agents holding what their is_applicable requires, found once per set of names held
+    presence_index = presence_reset = presence_method = ''
+    if requirements:
+        agent_helpers += ', _requirements'
+        presence_index = '''
+        # the attributes and relations each rule's is_applicable requires agents to hold, and which rules' requirements
+        # agents holding each set of names meet, as ({attribute names: (whether each rule's are met, ...)}, {relation
+        # names: (...)}); see _presence
+        self.rule_requirements = []
+        self.presence = ({}, {})'''
+        presence_reset = '''
+        self.rule_requirements = [_requirements.get(type(rule).__name__) for rule in self.rules]
+        self.presence = ({}, {})'''
+        # with presence off, nothing is kept, so agents work out which requirements they meet every step
+        keep = 'self.presence[kind][names] = ' if presence else ''
+        presence_method = f'''
+    def _presence(self, names, kind):
+        """
+        Works out which rules' requirements (the attributes, or relations, their is_applicable requires) agents holding
+        a set of names of attributes (or relations) meet. Agents hold interned sets of names (_attr and _rel), of which
+        there are few, so this is only done once for each, and kept in presence for agents' steps to look up.
+        :param names: The names of the attributes or relations an agent holds
+        :param kind: 0 for attributes, 1 for relations
+        :return: A tuple of whether the names meet the requirements of each rule in rules
+        """
+        met = {keep}tuple(need is None or need[kind] <= names for need in self.rule_requirements)
+        return met
+'''
+    rule_setup = presence_reset + rule_filters
+    # several features may need the same helper, which is only imported once
+    agent_helpers = ''.join(f', {helper}' for helper in dict.fromkeys(agent_helpers.split(', ')[1:]))
     code = f'''"""
 A custom Model class for a Mesa simulation.
 """
 
-from .{agent_module} import {agent_module}, GroupQry
-import json
+from .{agent_module} import {agent_module}, GroupQry, SiteRef, _clones, _ident, _window{agent_helpers}, {', '.join(stage_list)}
+{timer_import}import json
 import os
+import sys
 import warnings
 from mesa import Agent, Model
 from mesa.space import NetworkGrid
 from mesa.time import SimultaneousActivation
-from .make_python_identifier import make_python_identifier as mpi
 import networkx as nx
 {custom_imports}
 
 
+{activation}
+
 class {class_name}(Model):
+
+    # keys of the change events (see subscribe) for agents added from vita_groups and agents removed after being voided
+    BIRTH = '__birth__'
+    REMOVAL = '__removal__'
     
-    def __init__(self, datacollector=None):
+    def __init__(self, datacollector=None, pool_size=1024):
         super().__init__()
         # work from directory this file is in
         os.chdir(os.path.dirname(os.path.realpath(__file__)))
-        self.schedule = SimultaneousActivation(self)
+        self.schedule = BufferedActivation(self)
+        # changes staged by agents' set and delete, as (agent, key, value) triples and {{(agent, key): None}}
+        self.staged_sets = []
+        self.staged_dels = {{}}
+        # agents that set __void__ (i.e. a Group.VOID split), to be removed at the end of the step
+        self.void_queue = {{}}
+        # removed agents kept for reuse by births (see reuse_agent); pool_size limits how many are kept
+        self.agent_pool = []
+        self.pool_size = pool_size
+        self.pool_hits = 0
+        self.pool_misses = 0
+        # callbacks for change events, as {{key: [callback]}} (see subscribe)
+        self.observers = {{}}
+        # the {{agent: None}} dicts in which the model's indexes note the agents changed, born or removed (see _track)
+        self._trackers = []{state_index}{value_index}{timer_state}
         self.G = nx.Graph()
         self.time = 0  # simple iteration counter
         self._generate_sites()
         self.grid = NetworkGrid(self.G)
         # make a dictionary of {{hash: site}} values for easy relation lookups in agent generation
         self.site_hashes = {{h: s for s, h in dict(self.G.nodes.data('hash')).items()}}
+        # one instance of each rule is shared by all agents (so rule data is only loaded once)
+        self.rules = [{', '.join(f'{r}(self)' for r in stage_list)}]
+        # whether each rule is applied at the current time, worked out once per step from its timer (see schedule_rules)
+        self.rule_windows = []
+        self.active_rules = (){rule_index}{presence_index}
+        self.schedule_rules()
         self._generate_agents()
         self.vita_groups = []
         self.datacollector = datacollector
         {f"""
         for a in self.schedule.agents:
             {class_name}._group_setup(self, a)
-            a.advance()  # apply changes""" 
+        self.advance()  # apply changes""" 
         if group_setup else ""}
         
         
@@ -439,6 +1560,9 @@ class {class_name}(Model):
             warnings.warn('This Model has no DataCollector! You may want to add one in the `datacollector` attribute '
                           'before running the model')
 
+        if len(self.rule_windows) != len(self.rules):  # rules were added or removed
+            self.schedule_rules()
+        time = self.time{rule_activation}{timer_wake}{cache_start}
         self.schedule.step()
         
         while self.vita_groups:
@@ -446,14 +1570,150 @@ class {class_name}(Model):
             a.unique_id = self.next_id()
             a.model = self
             self.schedule.add(a)
-
-        for a in self.schedule.agents:
-            if a.get('__void__', False):
-                self.grid._remove_agent(a, a.pos)
-                self.schedule.remove(a)
+            if a.pos is not None:
+                self.grid.place_agent(a, a.pos)
+            if self.observers:
+                self._notify(a, self.BIRTH, None, None)
+            if self._trackers:
+                self._note((a,))
+
+        # only agents that were voided this step need to be checked
+        void_queue, self.void_queue = self.void_queue, {{}}
+        for a in void_queue:
+            if a.get('__void__', False):  # the agent may have been un-voided later in the same step
+                if a.pos is not None:
+                    self.grid._remove_agent(a, a.pos)
+                self.schedule.remove(a){timer_cleanup}
+                if self.observers:
+                    self._notify(a, self.REMOVAL, None, None)
+                if self._trackers:
+                    self._note((a,)){retire}
 
         self.time += 1
-            
+
+    def schedule_rules(self):
+        """
+        Compiles the timer (i) of each rule in rules into the times at which the rule is applied, from which each step
+        works out once which rules are active, so that agents are only checked against those (and not stepped at all
+        if there are none). Called again by step if rules are added or removed; must be called if timers are changed.
+        """{timer_stop}
+        self.rule_windows = [_window(rule.i) for rule in self.rules]
+        time = self.time
+        self.active_rules = tuple(window is None or time in window for window in self.rule_windows){rule_setup}
+
+    def reuse_agent(self):
+        """
+        Takes a removed agent out of the pool, so that a birth can reinitialize it in place instead of allocating a new
+        one. Counts hits (an agent was reused) and misses (the pool was empty) in pool_hits and pool_misses.
+        Agents still referenced anywhere else (e.g. kept by an observer or user code) are dropped from the pool instead,
+        so that nothing holding a removed agent sees it turn into another.
+        :return: A removed agent, or None if the pool is empty
+        """
+        pool = self.agent_pool
+        while pool:
+            agent = pool.pop()
+            if sys.getrefcount(agent) == 2:  # only referenced here (and by getrefcount's argument)
+                self.pool_hits += 1
+                return agent
+        self.pool_misses += 1
+        return None
+
+    def advance(self):
+        """
+        Makes all changes staged by agents (with set and delete) since the last call, then clears them.
+        Within each agent, later sets of the same key win, and deletions are made after all sets.
+        """{cache_end}
+        staged_sets, self.staged_sets = self.staged_sets, []
+        staged_dels, self.staged_dels = self.staged_dels, {{}}
+        if self.observers:
+            self._advance_observed(staged_sets, staged_dels)
+            return
+        if self._trackers:
+            self._note([agent for agent, _, _ in staged_sets] + [agent for agent, _ in staged_dels])
+
+        for agent, key, value in staged_sets:
+            setattr(agent, key, value)
+
+        for agent, key in staged_dels:
+            delattr(agent, key)
+{presence_method}
+    # ------------------------- CHANGE EVENTS -------------------------
+
+    def subscribe(self, key, callback):
+        """
+        Has callback(agent, key, old, new) called after each actual change to an agent's attribute or relation key
+        made by set or delete (including moves on the grid). Missing values are given as None. While anything is
+        subscribed, timers are not run (see _defer).
+        :param key: The name of an attribute or relation ('@' or 'pos' for position), BIRTH for agents added from
+                    vita_groups, REMOVAL for voided agents being removed (for both of which, old and new are None), or
+                    None for every change and event
+        :param callback: A function taking an agent, the (python-safe) key, and the old and new values
+        """{timer_stop}
+        self.observers.setdefault(self._event_key(key), []).append(callback)
+
+    def unsubscribe(self, key, callback):
+        """
+        Stops calling a callback previously subscribed to key.
+        :param key: The key the callback was subscribed to (see subscribe)
+        :param callback: The subscribed function
+        """
+        key = self._event_key(key)
+        self.observers[key].remove(callback)
+        if not self.observers[key]:
+            del self.observers[key]
+
+    def _event_key(self, key):
+        """Returns the key under which changes to an attribute or relation (or other events) are reported"""
+        if key is None or key == self.BIRTH or key == self.REMOVAL:
+            return key
+        return 'pos' if key in ('@', 'pos') else _ident(key)
+
+    def _notify(self, agent, key, old, new):
+        """Calls the callbacks subscribed to key and to every change"""
+        for callback in self.observers.get(key, ()):
+            callback(agent, key, old, new)
+        for callback in self.observers.get(None, ()):
+            callback(agent, key, old, new)
+
+    def _advance_observed(self, staged_sets, staged_dels):
+        """Makes staged changes like advance, reporting the changes to subscribed keys"""
+        if self._trackers:
+            self._note([agent for agent, _, _ in staged_sets] + [agent for agent, _ in staged_dels])
+        observers = self.observers
+        for agent, key, value in staged_sets:
+            name = self._event_key(key)
+            if name not in observers and None not in observers:
+                setattr(agent, key, value)
+                continue
+            old = agent.get(name)
+            setattr(agent, key, value)
+            new = agent.get(name)
+            if old != new:
+                self._notify(agent, name, old, new)
+
+        for agent, key in staged_dels:
+            name = self._event_key(key)
+            if name not in observers and None not in observers:
+                delattr(agent, key)
+                continue
+            old = agent.get(name)
+            delattr(agent, key)
+            self._notify(agent, name, old, None)
+
+    def _track(self, changes):
+        """
+        Notes the agents changed, born or removed from now on in changes, a dict kept as {{agent: None}} by an index of
+        the model to bring itself up to date from. Unlike subscribe, this leaves advance (and timers) as they are.
+        """
+        self._trackers.append(changes)
+
+    def _note(self, agents):
+        """Notes agents as changed for every index the model keeps (see _track)"""
+        agents = dict.fromkeys(agents)
+        for changes in self._trackers:
+            changes.update(agents)
+
+{timer_methods}
     # ------------------------- INITIALIZATION HELPERS -------------------------
 
     def _generate_agents(self):
@@ -464,10 +1724,18 @@ class {class_name}(Model):
         """
         with open("{group_file}", 'r') as file:
             j = json.load(file)
-            for group in j:
-                for _ in range(group['m']): 
-                    a = {name}Agent(self.next_id(), self, group['attr'], group['rel'])
-                    self.schedule.add(a)
+        for group in j:
+            if group['m'] < 1:
+                continue
+            # all members of a group are identical, so only the first is built from the group data; the rest are
+            # clones of it
+            prototype = {name}Agent(self.next_id(), self, group['attr'], group['rel'])
+            self.schedule.add(prototype)
+            for a in _clones(prototype, group['m'] - 1):
+                a.unique_id = self.next_id()
+                self.schedule.add(a)
+                if a.pos is not None:
+                    self.grid.place_agent(a, a.pos)
     
     def _generate_sites(self):
         """
@@ -477,9 +1745,11 @@ class {class_name}(Model):
         with open("{site_file}", 'r') as file:
             j = json.load(file)
             for site in j:
-                self.G.add_node(str(site['name']), hash=site['hash'], rel_name=site['rel_name'])
+                # nodes are keyed by interned SiteRefs, which agents then use for relations
+                ref = SiteRef(str(site['name']))
+                self.G.add_node(ref, hash=site['hash'], rel_name=site['rel_name'])
                 for k, v in site['attr'].items():
-                    self.G.nodes[str(site['name'])][k] = v
+                    self.G.nodes[ref][k] = v
 
 {textwrap.indent(group_setup, '    ') if group_setup else ""}
 
@@ -492,13 +1762,13 @@ class {class_name}(Model):
         """
         Retrieves an attribute of a Mesa Agent or NetworkGrid node.
         :param name: A string containing the attribute to retrieve, or None
-        :param agent_or_node: A Mesa Agent or a string corresponding to a node in the NetworkGrid
+        :param agent_or_node: A Mesa Agent or a string (or SiteRef) corresponding to a node in the NetworkGrid
         :return: If agent_or_node is a string, returns the named attribute represented by it, or the node's entire
                      attribute dictionary if name is None (note: this includes the special 'agent' attribute)
                  If agent_or_node is an Agent, returns the named attribute of that Agent
         """
-        name = mpi(name) if name is not None else name
-        if isinstance(agent_or_node, str):
+        name = _ident(name) if name is not None else name
+        if isinstance(agent_or_node, (str, SiteRef)):
             node_dict = self.grid.G.nodes[agent_or_node]
             return node_dict.get(name) if name is not None else node_dict
         elif isinstance(agent_or_node, Agent):
@@ -514,31 +1784,176 @@ class {class_name}(Model):
     def get_groups(self, node_or_model, qry=None):
         """
         Returns a list of agents at the node or the entire model that satisfy the qry. 
-        :param node_or_model: A string corresponding to a node in the NetworkGrid, or a Mesa Model
+        Queries of this model are answered from its indexes (see query_plan), and only once per step (see _cached).
+        :param node_or_model: A string (or SiteRef) corresponding to a node in the NetworkGrid, or a Mesa Model
         :param qry: a GroupQry namedtuple
         :return: a list of agents at the node satisfying the qry. 
         """
         if isinstance(node_or_model, Model):
+            if not qry:
+                return list(node_or_model.schedule.agents)
+        elif isinstance(node_or_model, (str, SiteRef)):
+            if not qry:
+                return self.grid.get_cell_list_contents([node_or_model])
+        else:
+            raise TypeError(f"get_groups expects a str or Model for node_or_model, but received {type(node_or_model)}")
+        return list(self._cached('groups', self._groups_of, node_or_model, qry))
+
+    def _groups_of(self, node_or_model, qry):
+        """Finds the agents at a node or in a model matching a GroupQry (see get_groups)"""'''
+        code += settle + '''
+        if isinstance(node_or_model, Model):
+            if node_or_model is self:
+                plan = self._index_sets(qry)
+                if plan is not None:
+                    return self._indexed(qry, *plan)
             agents = node_or_model.schedule.agents
-        elif isinstance(node_or_model, str):
+        else:
             agents = self.grid.get_cell_list_contents([node_or_model])
+        # call the compiled predicate directly instead of going through each agent's matches_qry
+        match = qry.match
+        return [a for a in agents if match(a)]
+
+    def _cached(self, kind, compute, target, qry):
+        """
+        Answers an aggregate query of a site or the whole model, which cannot change while agents step: from just
+        before the schedule steps until advance, results are kept in query_cache (counting query_hits and query_misses).
+        :param kind: What is computed, e.g. 'mass'
+        :param compute: A function taking target and qry, and returning the result
+        :param target: A string (or SiteRef) corresponding to a node in the NetworkGrid, or a Mesa Model
+        :param qry: a GroupQry namedtuple
+        :return: The result of compute(target, qry), which must not be changed by the caller
+        """
+        cache = self.query_cache
+        if cache is None:
+            return compute(target, qry)
+        try:
+            key = (kind, target, _qry_key(qry))
+            result = cache.get(key)
+        except (TypeError, ValueError):  # a query holding unhashable values
+            return compute(target, qry)
+        if result is None:
+            self.query_misses += 1
+            result = cache[key] = compute(target, qry)
         else:
-            raise TypeError(f"get_groups expects a str or Model for node_or_model, but received {type(node_or_model)}")
-        
-        return [a for a in agents if a.matches_qry(qry)]
-        # if not qry:
-        #     return agents
-        # # the code below is REALLY PAINFUL... replacing it with 'return agents` makes the code run like 20x faster
-        # elif qry.full:
-        #     return [a for a in agents
-        #             if qry.attr.items() == {k: getattr(a, k) for k in a._attr}.items()
-        #             and qry.rel.items() == {k: getattr(a, k) for k in a._rel}.items()
-        #             and all([fn(a) for fn in qry.cond])]
-        # else:
-        #     return [a for a in agents
-        #             if qry.attr.items() <= {k: getattr(a, k) for k in a._attr}.items()
-        #             and qry.rel.items() <= {k: getattr(a, k) for k in a._rel}.items()
-        #             and all([fn(a) for fn in qry.cond])]
+            self.query_hits += 1
+        return result
+
+    def query_plan(self, qry):
+        """
+        Describes how get_groups finds the agents of the model matching a GroupQry: the sets of agents holding each
+        value it compares are looked up in value_index and intersected smallest first; anything else is then checked.
+        :param qry: a GroupQry namedtuple
+        :return: A tuple of ([(key, value, number of agents holding it), ...] in the order intersected, whether the
+                 agents left are then matched against qry), or None if every agent is matched against qry instead (as
+                 qry compares no attributes or relations, or holds unhashable values)
+        """
+        plan = self._index_sets(qry)
+        if plan is None:
+            return None
+        found, checked = plan
+        return [(key, value, len(ids)) for key, value, ids in found], checked
+
+    def _index_sets(self, qry):
+        """
+        Looks up the sets of unique_ids of the agents holding each value a GroupQry compares (see query_plan). The
+        model only starts indexing agents, and keeping track of changes (see _track), when first queried.
+        :param qry: a GroupQry namedtuple
+        :return: A tuple of ([(key, value, set of unique_ids), ...] smallest first, whether the agents in all the sets
+                 must still be matched against qry), or None if the indexes cannot answer qry
+        """'''
+        code += settle + '''
+        items = list(qry.attr.items()) + list(qry.rel.items())
+        if not items or not self.indexed:
+            return None
+        if self.value_index is None:
+            self.value_index = {}
+            self._track(self.value_changes)
+        self._index_values()
+
+        found = []
+        for key, value in items:
+            index = self.value_index.get(key)
+            if index is None:
+                index = self.value_index[key] = self._index_key(key)
+            if not index:
+                return None
+            try:
+                found.append((key, value, index[0].get(_encoded(key, value), frozenset())))
+            except TypeError:
+                return None
+        found.sort(key=lambda f: len(f[2]))
+        return found, bool(qry.cond or qry.full)
+
+    def _indexed(self, qry, found, checked):
+        """
+        Returns the agents matching a GroupQry, from the sets of agents holding the values it compares (see _index_sets)
+        :param qry: a GroupQry namedtuple
+        :param found: The (key, value, set of unique_ids) of each value qry compares, smallest set first
+        :param checked: Whether the agents in every set must still be matched against qry
+        :return: A list of the agents matching qry, in the order they were added to the model (that of their unique_ids)
+        """
+        ids = found[0][2]
+        if len(found) > 1:
+            ids = ids.intersection(*(ids for _, _, ids in found[1:]))
+        agents = self.schedule._agents
+        matched = [agents[i] for i in sorted(ids)]
+        if checked:
+            match = qry.match
+            matched = [a for a in matched if match(a)]
+        return matched
+
+    def _index_key(self, key):
+        """
+        Indexes the agents by the value they hold under key (see query_plan).
+        :param key: The (python-safe) name of an attribute or relation
+        :return: A tuple of ({value: {unique_id}}, {agent: (unique_id, value)}), or False if an agent holds an
+                 unhashable value under key
+        """
+        index, entries = {}, {}
+        for agent in self.schedule.agents:
+            value = _lookup(agent, key)
+            if value is _MISSING:
+                continue
+            try:
+                index.setdefault(value, set()).add(agent.unique_id)
+            except TypeError:
+                return False
+            entries[agent] = (agent.unique_id, value)
+        return index, entries
+
+    def _index_values(self):
+        """
+        Brings value_index up to date with the agents changed, born or removed since the last call. Indexes that would
+        need an agent's unhashable value are given up on, so that queries of their keys match every agent.
+        """
+        changed = list(self.value_changes)
+        self.value_changes.clear()
+        if not changed:
+            return
+        present = self.schedule._agents
+        for key, indexed in list(self.value_index.items()):
+            if not indexed:
+                continue
+            index, entries = indexed
+            for agent in changed:
+                old = entries.pop(agent, None)
+                if old is not None:
+                    ids = index[old[1]]
+                    ids.discard(old[0])
+                    if not ids:
+                        del index[old[1]]
+                if present.get(agent.unique_id) is not agent:
+                    continue
+                value = _lookup(agent, key)
+                if value is _MISSING:
+                    continue
+                try:
+                    index.setdefault(value, set()).add(agent.unique_id)
+                except TypeError:
+                    self.value_index[key] = False
+                    break
+                entries[agent] = (agent.unique_id, value)
     '''
 
     if {'get_mass', 'get_mass_prop', 'get_mass_and_prop'} & used_functions:
@@ -546,24 +1961,145 @@ class {class_name}(Model):
     def get_mass(self, agent_node_model, qry=None):
         """
         If agent_node_model is an agent, returns the number of agents with the same attributes as it, including itself.
-        This ignores unique_id (and source_name).
-        This is probably very unoptimized.
-        If agent_node_model is a string corresponding to a node in the NetworkGrid, returns the number of agents at that
-        node with the attributes specified in qry, or all agents at that node if qry is None.
+        This ignores unique_id (and source_name). Agents are counted by state (see _count_states).
+        If agent_node_model is a string (or SiteRef) corresponding to a node in the NetworkGrid, returns the number of agents at that
+        node with the attributes specified in qry, or all agents at that node if qry is None (see _site_mass).
         If agent_node_model is a Model, returns the total number of agents in the model.
         """
-        if isinstance(agent_node_model, str):
-            return len(self.get_groups(agent_node_model, qry))
+        if isinstance(agent_node_model, (str, SiteRef)):
+            if not qry:
+                return len(self.grid.G.nodes[agent_node_model]['agent'])
+            return self._cached('mass', self._node_mass, agent_node_model, qry)
         elif isinstance(agent_node_model, Agent):
-            mod_dict = {k: v for k, v in agent_node_model.__dict__.items()
+            if self.indexed:
+                self._count_states()
+                try:
+                    return self.state_counts.get(_signature(agent_node_model), 0)
+                except TypeError:  # the agent holds unhashable values, so compare it with every agent instead
+                    pass
+            mod_dict = {k: v for k, v in _vars(agent_node_model).items()
                         if k not in ('unique_id', 'source_name')} # toss unique identifiers
-            return sum([mod_dict == {k: v for k, v in a.__dict__.items() if k not in ('unique_id', 'source_name')}
+            return sum([mod_dict == {k: v for k, v in _vars(a).items() if k not in ('unique_id', 'source_name')}
                         for a in self.schedule.agents])
         elif isinstance(agent_node_model, Model):
             return len(agent_node_model.schedule.agents)
         else:
             raise TypeError(f"get_mass expects a str, Agent, or Model for agent_node_model, but received "
                             f"{type(agent_node_model)}")
+
+    def _node_mass(self, node, qry):
+        """Counts the agents at a node matching a GroupQry (see get_mass)"""
+        if not qry.cond and self.indexed:
+            m = self._site_mass(node, qry)
+            if m is not None:
+                return m
+        return len(self._cached('groups', self._groups_of, node, qry))
+
+    def _count_states(self):
+        """
+        Brings state_counts, the number of agents with each signature (see _signature), up to date with the agents
+        changed since the last call. Agents are first counted (and tracked; see _track) on the first call.
+        """
+        if self.state_counts is None:
+            self.state_counts = {}
+            self.changed_agents.update(dict.fromkeys(self.schedule.agents))
+            self._track(self.changed_agents)
+
+        changed = list(self.changed_agents)
+        self.changed_agents.clear()
+        counts = self.state_counts
+        present = self.schedule._agents
+        for agent in changed:
+            old = self.agent_states.pop(agent, None)
+            if old is not None:
+                counts[old] -= 1
+                if not counts[old]:
+                    del counts[old]
+            if present.get(agent.unique_id) is agent:
+                try:
+                    new = _signature(agent)
+                    counts[new] = counts.get(new, 0) + 1
+                except TypeError:
+                    continue
+                self.agent_states[agent] = new
+
+    def _site_mass(self, node, qry):
+        """
+        Counts the agents at a node matching a GroupQry without conditions from site_counts, the number of agents at
+        each site holding each combination of values of the queried keys, made when the keys are first queried.
+        :param node: A string (or SiteRef) corresponding to a node in the NetworkGrid
+        :param qry: A GroupQry without conditions
+        :return: The number of agents at node matching qry, or None if they cannot be counted (as agents or qry hold
+                 unhashable values)
+        """
+        if self.site_counts is None:
+            self.site_counts = {}
+            self._track(self.site_changes)
+        self._count_sites()
+
+        items = sorted([(k, _encoded(k, v)) for k, v in qry.attr.items()] + list(qry.rel.items()), key=lambda i: i[0])
+        keys = tuple(k for k, _ in items)
+        values = tuple(v for _, v in items)
+        if qry.full:
+            values = (frozenset(qry.attr), frozenset(qry.rel), values)
+        tally = self.site_counts.get((keys, qry.full))
+        if tally is None:
+            tally = self.site_counts[keys, qry.full] = self._count_site_keys(keys, qry.full)
+        if not tally:
+            return None
+        try:
+            return tally[0].get((node, values), 0)
+        except TypeError:
+            return None
+
+    def _count_site_keys(self, keys, full):
+        """
+        Counts the agents at each site by the values they hold under keys (see _site_mass).
+        :param keys: The (python-safe) names of the attributes and relations queried, in order
+        :param full: Whether the query was full, in which case agents are also counted by the names they hold
+        :return: A tuple of ({(site, values): count}, {agent: (site, values)}), or False if any agent holds unhashable
+                 values under keys
+        """
+        counts, entries = {}, {}
+        for agent in self.schedule.agents:
+            if agent.pos is None:
+                continue
+            try:
+                entry = (agent.pos, _count_key(agent, keys, full))
+            except TypeError:
+                return False
+            entries[agent] = entry
+            counts[entry] = counts.get(entry, 0) + 1
+        return counts, entries
+
+    def _count_sites(self):
+        """
+        Brings site_counts up to date with the agents changed, moved, born or removed since the last call. Counts that
+        would need an agent's unhashable values are given up on, so that queries of their keys look at the agents.
+        """
+        changed = list(self.site_changes)
+        self.site_changes.clear()
+        if not changed:
+            return
+        present = self.schedule._agents
+        for (keys, full), tally in list(self.site_counts.items()):
+            if not tally:
+                continue
+            counts, entries = tally
+            for agent in changed:
+                old = entries.pop(agent, None)
+                if old is not None:
+                    counts[old] -= 1
+                    if not counts[old]:
+                        del counts[old]
+                if present.get(agent.unique_id) is not agent or agent.pos is None:
+                    continue
+                try:
+                    new = entries[agent] = (agent.pos, _count_key(agent, keys, full))
+                except TypeError:
+                    self.site_counts[keys, full] = False
+                    break
+                counts[new] = counts.get(new, 0) + 1
 '''
 
     if 'get_mass_prop' in used_functions or 'get_mass_and_prop' in used_functions:
@@ -571,7 +2107,7 @@ class {class_name}(Model):
     def get_mass_prop(self, node, qry=None):
         """
         Returns the fraction of agents at the given node with attributes satisfying the given qry.
-        :param node: A string corresponding to a node in the NetworkGrid
+        :param node: A string (or SiteRef) corresponding to a node in the NetworkGrid
         :param qry: a GroupQry namedtuple
         :return: The fraction of agents at node with attributes satisfying qry (if qry=None, this will usually be 1),
                  *unless* the node is empty, in which case returns 0.
@@ -586,7 +2122,7 @@ class {class_name}(Model):
         """
         Returns a tuple containing the number of agents at the given node satisfying the qry and the fraction of
         agents at that site satisfying the qry.
-        :param node: A string corresponding to a node in the NetworkGrid
+        :param node: A string (or SiteRef) corresponding to a node in the NetworkGrid
         :param qry: a GroupQry namedtuple
         :return: a tuple containing the number of agents at the given node satisfying the qry and the fraction of
         agents at that site satisfying the qry.
@@ -599,10 +2135,26 @@ class {class_name}(Model):
     def get_groups_mass(self, qry=None):
         """
         Returns the number of agents in the model that satisfy the given qry, or all agents if qry is None.
+        Queries of attributes and relations alone are counted from the model's indexes (see query_plan) without
+        listing the agents.
         :param qry: a GroupQry namedtuple
         :return: the number of agents in the model that satisfy the given qry
         """
-        return len(self.get_groups(self, qry))
+        if not qry:
+            return len(self.schedule.agents)
+        return self._cached('mass', self._model_mass, self, qry)
+
+    def _model_mass(self, model, qry):
+        """Counts the agents of the model matching a GroupQry (see get_groups_mass)"""
+        plan = self._index_sets(qry)
+        if plan is None:
+            return len(self._cached('groups', self._groups_of, model, qry))
+        found, checked = plan
+        if checked:
+            return len(self._indexed(qry, found, checked))
+        if len(found) == 1:
+            return len(found[0][2])
+        return len(found[0][2].intersection(*(ids for _, _, ids in found[1:])))
 '''
 
     if 'get_groups_mass_prop' in used_functions or 'get_groups_mass_and_prop' in used_functions:
@@ -763,6 +2315,453 @@ def translate_rules(ruletypes: Iterable[type], writer: RuleWriter) -> Tuple[List
     return new_rules, rule_imports
 
 
+def _collect_names(sim: Simulation, writer: RuleWriter) -> Set[str]:
+    """
+    Gathers the (python-safe) names of every attribute and relation that agents are known to hold: those of the
+    simulation's groups and those set or deleted in the translated rules' GroupSplitSpecs.
+    Must be called after the rules are translated by writer.
+    :param sim: The PyPRAM Simulation being translated
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :return: A set of attribute and relation names. Position ('@') is excluded since Mesa stores it in pos.
+    """
+    names = set(writer.gss_keys)
+    for group in sim.pop.get_groups():
+        names.update(mpi(k) for k in group.get_attrs())
+        names.update(mpi(k) for k in group.rel if k != '@')
+    return names
+
+
+def _identifier_table(sim: Simulation, writer: RuleWriter) -> Dict[str, str]:
+    """
+    Maps every attribute and relation name known at translation time (of the simulation's groups, sites and rules),
+    as well as its python-safe identifier, to that identifier. Must be called after the rules are translated by writer.
+    :param sim: The PyPRAM Simulation being translated
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :return: A dictionary mapping names to python-safe identifiers
+    """
+    names = set(writer.names)
+    for group in sim.pop.get_groups():
+        names.update(group.get_attrs())
+        names.update(group.rel)
+    for site in sim.pop.sites.values():
+        names.update(site.get_attr())
+    for rule in sim.rules:
+        qry = getattr(rule, 'group_qry', None)
+        if qry:
+            names.update(qry.attr)
+            names.update(qry.rel)
+    table = {}
+    for n in names:
+        if isinstance(n, str):
+            table[n] = table[mpi(n)] = mpi(n)
+    return table
+
+
+def _categorical_attributes(sim: Simulation, writer: RuleWriter, max_values: int = 64) -> Dict[str, List[str]]:
+    """
+    Finds the attributes whose values known at translation time (in groups and GroupSplitSpecs) are a few strings, such
+    as 'flu' taking 's', 'i' and 'r'. Must be called after the rules are translated by writer.
+    :param sim: The PyPRAM Simulation being translated
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :param max_values: The most values a categorical attribute may have
+    :return: A dictionary mapping the python-safe names of categorical attributes to their sorted known values
+    """
+    known = [(mpi(k), v) for group in sim.pop.get_groups() for k, v in group.get_attrs().items()]
+    known.extend(writer.gss_values)
+    rejected = {mpi(k) for group in sim.pop.get_groups() for k in group.rel}
+    values = {}
+    for name, value in known:
+        if isinstance(value, str):
+            values.setdefault(name, set()).add(value)
+        else:
+            rejected.add(name)
+    return {name: sorted(v) for name, v in values.items() if name not in rejected and len(v) <= max_values}
+
+
+def _rule_guards(sim: Simulation) -> List[Tuple[bool, Optional[Tuple]]]:
+    """
+    Describes the checks made before each of a simulation's rules is applied to an agent, for _fused_step.
+    A rule is always applied if the i stored in its JSON data is IterAlways (or otherwise falsy, such as IterPoint(0));
+    otherwise whether it is applied at a given time is worked out by the model (see the Model's schedule_rules).
+    :param sim: The PyPRAM Simulation being translated
+    :return: A list with a (whether the rule is always applied, group_qry key) tuple for each rule, in order. The key
+             is None if the rule has no group_qry; rules with identical group_qrys have equal keys
+    """
+    guards = []
+    loaded = {}
+    for rule in sim.rules:
+        # a translated rule loads the JSON data of the first rule of its type, so that rule's checks are the ones made
+        rule = loaded.setdefault(type(rule).__name__, rule)
+        always = isinstance(rule.i, IterAlways) or isinstance(rule.i, IterPoint) and not rule.i.i
+        qry = rule.group_qry
+        # the same key as the group_qry's JSON data (see create_json_data)
+        key = (json.dumps(qry.attr, sort_keys=True, default=repr), json.dumps(qry.rel, sort_keys=True, default=repr),
+               dill.dumps(qry.cond).hex(), qry.full) if qry else None
+        guards.append((always, key))
+    return guards
+
+
+def _access_of(rule: type, writer: RuleWriter) -> Tuple[Set[str], Set[str], Set[str], Set[str]]:
+    """
+    Collects what a rule (including the rules it inherits from) reads and writes, as found by writer (see
+    RuleWriter._record_access).
+    :param rule: A PyPRAM Rule class
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :return: A tuple of sets of the (python-safe) names the rule reads of the agent it is applied to, sets, deletes,
+             and reads of other agents
+    """
+    reads, sets, dels, queries = set(), set(), set(), set()
+    for cls in rule.__mro__:
+        for found, access in zip((reads, sets, dels, queries), writer.access.get(cls.__name__, ())):
+            found.update(access)
+    return reads, sets, dels, queries
+
+
+def _requirements(sim: Simulation, writer: RuleWriter) -> Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]]:
+    """
+    Works out which attributes and relations each rule's is_applicable requires of agents (see
+    RuleWriter._record_requirements), resolving names held by the first rule of each type (such as self.var).
+    Must be called after the rules are translated by writer.
+    :param sim: The PyPRAM Simulation being translated
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :return: A dictionary of {rule class name: (the (python-safe) names of attributes, and of relations, its agents
+             must hold)}, for the rules requiring any
+    """
+    requirements = {}
+    for rule in sim.rules:
+        name = type(rule).__name__
+        if name in requirements:
+            continue
+        names = (set(), set())
+        for cls in type(rule).__mro__:  # the nearest is_applicable, and those it defers to
+            if cls.__name__ not in writer.requirements:
+                continue
+            literals, fields, inherits = writer.requirements[cls.__name__]
+            for kind in (0, 1):
+                names[kind].update(literals[kind])
+                for field_name in fields[kind]:
+                    value = getattr(rule, field_name, None)
+                    values = [value] if isinstance(value, str) else value if isinstance(value, (list, tuple)) else ()
+                    names[kind].update(v for v in values if isinstance(v, str))
+            if not inherits:
+                break
+        requirements[name] = tuple(frozenset('pos' if n == '@' else mpi(n) for n in found) for found in names)
+    return {name: needs for name, needs in requirements.items() if any(needs)}
+
+
+def _write_mode(sim: Simulation, writer: RuleWriter) -> Tuple[bool, str]:
+    """
+    Decides whether agents may make their rules' changes as they step, instead of staging them until every agent has
+    stepped, which is safe if no rule can see a change made earlier in the same step (see RuleWriter._record_access).
+    Must be called after the rules are translated by writer.
+    :param sim: The PyPRAM Simulation being translated
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :return: A tuple of (whether changes may be made directly, the reason for the decision)
+    """
+    any_ = RuleWriter.ANY
+
+    def overlap(a, b):
+        return bool(a & b) or bool(a) and any_ in b or bool(b) and any_ in a
+
+    rules = []
+    loaded = {}
+    for rule in sim.rules:
+        name = type(rule).__name__
+        reads, sets, dels, queries = _access_of(type(rule), writer)
+        # a translated rule loads the JSON data of the first rule of its type (see _rule_guards)
+        qry = loaded.setdefault(name, rule).group_qry
+        if qry:
+            reads.update(mpi(k) for k in qry.attr)
+            reads.update('pos' if k == '@' else mpi(k) for k in qry.rel)
+            if qry.cond:
+                reads.add(any_)
+        rules.append((name, reads, sets | dels, queries))
+
+    all_sets = set().union(*(writer.access[r][1] for r in writer.access))
+    all_dels = set().union(*(writer.access[r][2] for r in writer.access))
+    writes = set().union(*(w for _, _, w, _ in rules))
+    for name, _, _, queries in rules:
+        if overlap(queries, writes):
+            return False, f'{name} queries other agents for attributes or relations that rules write'
+    if overlap(all_sets, all_dels):
+        return False, 'rules both set and delete the same attributes or relations'
+    if len(rules) > 1:
+        # rules are told apart by position, as several may be of the same class
+        for i, (name, reads, _, _) in enumerate(rules):
+            for j, (other, _, other_writes, _) in enumerate(rules):
+                if i != j and overlap(reads, other_writes):
+                    other = f'another {other}' if other == name else other
+                    return False, f'{name} reads attributes or relations that {other} writes'
+    return True, 'no rule reads what rules write in the same step'
+
+
+def _mentioned(functions: Iterable[Any]) -> Set[str]:
+    """
+    Finds the attributes and relations the conditions of a group query may read: the (python-safe) names among the
+    string constants of their code, or RuleWriter.ANY if a condition reads anything besides its argument.
+    :param functions: The conditions of a group query
+    :return: A set of names
+    """
+    names = set()
+    codes = [getattr(f, '__code__', None) for f in functions or ()]
+    while codes:
+        code = codes.pop()
+        loads = {i.opname for i in dis.get_instructions(code)} if code is not None else set()
+        if code is None or loads & {'LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_DEREF', 'LOAD_CLASSDEREF', 'LOAD_CLOSURE'}:
+            return {RuleWriter.ANY}
+        for const in code.co_consts:
+            if isinstance(const, str):
+                names.add('pos' if const == '@' else mpi(const))
+            elif inspect.iscode(const):
+                codes.append(const)
+    return names
+
+
+def _timer_rules(sim: Simulation, writer: RuleWriter, guards: List[Tuple[bool, Optional[Tuple]]],
+                 categories: Dict[str, List[str]]) -> Tuple[Dict[int, Tuple[str, int, int, Tuple]], str]:
+    """
+    Decides which timers (see RuleWriter._record_timer) the model may run as clocks instead of applying them every
+    step, which is only safe if nothing but the agent's __getattr__ reads the counters meanwhile (see hazard below).
+    Must be called after the rules are translated by writer.
+    :param sim: The PyPRAM Simulation being translated
+    :param writer: The RuleWriter used to translate the simulation's rules
+    :param guards: Whether each rule is always applied, and its group_qry key (see _rule_guards)
+    :param categories: The categorical attributes of the simulation (see _categorical_attributes)
+    :return: A tuple of ({index of the rule in the model's rules: (tested counter, the value it fires at, its step,
+             ((counter, step), ...))} for the timers to schedule, and the reason for the decision, or '' if no rule is
+             a timer)
+    """
+    any_ = RuleWriter.ANY
+    names = [type(rule).__name__ for rule in sim.rules]
+    qrys = []
+    loaded = {}
+    for rule in sim.rules:
+        # a translated rule loads the JSON data of the first rule of its type (see _rule_guards)
+        qry = loaded.setdefault(type(rule).__name__, rule).group_qry
+        if qry:
+            qrys.append(({mpi(k): v for k, v in qry.attr.items()},
+                         {('pos' if k == '@' else mpi(k)): v for k, v in qry.rel.items()}, _mentioned(qry.cond),
+                         qry.full))
+        else:
+            qrys.append(({}, {}, set(), False))
+    access = [_access_of(type(rule), writer) for rule in sim.rules]
+
+    def disjoint(a, b):  # no agent can match both group queries
+        return any(k in b[n] and b[n][k] != v for n in (0, 1) for k, v in a[n].items())
+
+    def hazard(k, steps):  # what may see the counters of the k-th rule (or keep it from applying) while it runs, if any
+        name = names[k]
+        counters = {c for c, _ in steps}
+        if names.count(name) > 1:
+            return f'{name} is applied more than once'
+        if not guards[k][0]:
+            return f'{name} is only applied at some times'
+        if counters & set(categories):
+            return f'the counters of {name} are categorical'
+        if 'copy' in writer.used:
+            return 'agents may be copied'
+        if {'get_mass', 'get_mass_prop', 'get_mass_and_prop'} & writer.used:
+            return 'agents may be counted by state (get_mass)'
+        read = set(qrys[k][0]) | set(qrys[k][1]) | qrys[k][2]
+        for j, ((attr, rel, cond, full), (reads, sets, dels, queries)) in enumerate(zip(qrys, access)):
+            if full:
+                return f'the group_qry of {names[j]} must match agents exactly'
+            if counters & (set(attr) | set(rel) | cond) or any_ in cond:
+                return f'the group_qry of {names[j]} queries agents for the counters of {name}'
+            if counters & queries or any_ in queries:
+                return (f'{names[j]} may query agents for the counters of {name} in aggregate (get_groups, '
+                        f'get_groups_mass, site masses), answered from the value index and site counts')
+            if any_ in sets:
+                return f'{names[j]} changes other agents'
+            if j == k or disjoint(qrys[k], qrys[j]):
+                continue
+            if counters & (reads | sets | dels) or any_ in reads:
+                return f'{names[j]} may read or write the counters of {name}'
+            if read & (sets | dels) or any_ in read:
+                return f'{names[j]} may change whether {name} applies to an agent'
+        return None
+
+    timers = {}
+    reasons = []
+    for k, name in enumerate(names):
+        if name not in writer.timers:
+            continue
+        counter, fires_at, steps = writer.timers[name]
+        reason = hazard(k, steps)
+        if reason:
+            reasons.append(reason)
+        else:
+            timers[k] = (counter, fires_at, dict(steps)[counter], steps)
+    if reasons:
+        return timers, '; '.join(reasons)
+    if timers:
+        return timers, 'nothing else sees the counters of ' + ', '.join(names[k] for k in timers)
+    return timers, ''
+
+
+def _own_state(functions: Iterable[Any]) -> bool:
+    """
+    Determines whether the conditions of a group query only read the agent they are given, through its has_attr,
+    has_rel, get_attr or get, e.g. `lambda g: g.has_attr({'is-migrating': True})`. Such a condition can only change
+    its mind about an agent when one of the agent's attributes or relations changes.
+    :param functions: The conditions of a group query
+    :return: True if every condition only reads its agent's own attributes and relations
+    """
+    # opcodes (by prefix, as they vary between versions of python) that only move and combine values already at hand
+    allowed = ('LOAD_FAST', 'STORE_FAST', 'LOAD_CONST', 'BUILD_', 'COMPARE_OP', 'IS_OP', 'CONTAINS_OP', 'UNARY_',
+               'BINARY_', 'JUMP', 'POP_JUMP', 'RETURN_', 'TO_BOOL', 'RESUME', 'NOP', 'POP_TOP', 'COPY', 'SWAP',
+               'DUP_TOP', 'ROT_', 'CALL', 'PRECALL', 'KW_NAMES', 'PUSH_NULL', 'CACHE', 'EXTENDED_ARG', 'LIST_', 'DICT_',
+               'SET_')
+    methods = {'has_attr', 'has_rel', 'ha', 'hr', 'get_attr', 'get'}
+    for f in functions or ():
+        code = getattr(f, '__code__', None)
+        if code is None:
+            return False
+        for i in dis.get_instructions(code):
+            if i.opname in ('LOAD_METHOD', 'LOAD_ATTR'):
+                if i.argval not in methods:
+                    return False
+            elif not i.opname.startswith(allowed):
+                return False  # a global, a closure, a nested function, another object's attribute, ...
+    return True
+
+
+def _sparse_rules(sim: Simulation, guards: List[Tuple[bool, Optional[Tuple]]],
+                  requirements: Dict[str, FrozenSet[str]] = None) -> Tuple[Optional[List[str]], str]:
+    """
+    Decides whether agents that no rule can currently apply to may be parked until they change or a rule becomes
+    active, which is worth doing if every rule always applied tells from an agent's own data whether it applies: by
+    'match' (its group_qry and requirements), 'filter' (its attributes and relations only) or not at all ('any').
+    :param sim: The PyPRAM Simulation being translated
+    :param guards: Whether each rule is always applied, and its group_qry key (see _rule_guards)
+    :param requirements: The names each rule's is_applicable requires agents to hold, by rule class name (see
+                         _requirements)
+    :return: A tuple of (how each rule tells whether it applies to an agent, in order, or None if agents are never
+             parked, and the reason for the decision)
+    """
+    requirements = requirements or {}
+    kinds = []
+    loaded = {}
+    for rule, (always, _) in zip(sim.rules, guards):
+        name = type(rule).__name__
+        # a translated rule loads the JSON data of the first rule of its type (see _rule_guards)
+        qry = loaded.setdefault(name, rule).group_qry
+        # whether some of what tells if the rule applies is the agent's own data, and whether some of it may not be
+        specific = bool(qry and (qry.attr or qry.rel or qry.full) or name in requirements)
+        foreign = bool(qry and qry.cond and not _own_state(qry.cond))
+        if specific and foreign:
+            kinds.append('filter')
+        elif specific or qry and qry.cond and not foreign:
+            kinds.append('match')
+        elif always:
+            return None, f'{name} may apply to any agent'
+        else:
+            kinds.append('any')
+    return kinds, 'whether any rule applies to an agent depends on its own attributes and relations'
+
+
+def _fused_step(guards: List[Tuple[bool, Optional[Tuple]]], timers: Dict[int, Tuple] = None,
+                sparse: List[str] = None,
+                requirements: List[Optional[Tuple[FrozenSet[str], FrozenSet[str]]]] = None) -> str:
+    """
+    Writes the body of an Agent step function that checks and applies every rule in turn as its __call__ would, but
+    inline: shared group_qrys are matched once, and timers (see Model._defer), requirements (see Model._presence) and
+    parking (see BufferedActivation.park) are checked in place. If rules were added or removed, each is called.
+    :param guards: Whether each rule in the model's rules is always applied, and its group_qry key (see _rule_guards)
+    :param timers: The timers the model schedules, by index of their rules (see _timer_rules)
+    :param sparse: How each rule tells whether it applies to an agent (see _sparse_rules), or None if agents are never
+                   parked
+    :param requirements: The attributes and the relations each rule's is_applicable requires agents to hold, or None
+                         (see _requirements)
+    :return: The (indented) code of the function's body
+    """
+    timers = timers or {}
+    requirements = requirements or [None] * len(guards)
+    # which of the attributes and the relations the agent holds any rule requires
+    kinds = [kind for kind in (0, 1) if any(needs and needs[kind] for needs in requirements)]
+    held = ['has_attrs', 'has_rels']
+
+    def met(n):
+        return [f'{held[kind]}[{n}]' for kind in kinds if requirements[n] and requirements[n][kind]]
+    keys = [key for _, key in guards]
+    # the first rule with each group_qry shared by more than one rule keeps its match in a local variable
+    shared = {key: keys.index(key) for key in keys if key is not None and keys.count(key) > 1}
+    names = [f'rule_{n}' for n in range(len(guards))]
+
+    def indent(lines, depth):
+        return ''.join(f'\n{"    " * depth}{line}' for line in lines)
+
+    code = """
+        model = self.model
+        time = model.time
+        rules = model.rules"""
+    if kinds:
+        # the requirements of the rules the agent meets, looked up by the (interned) names it holds
+        code += """
+        presence = model.presence"""
+        code += ''.join(f"""
+        {held[kind]} = presence[{kind}].get(self.{names}) or model._presence(self.{names}, {kind})"""
+                        for kind, names in ((kind, ('_attr', '_rel')[kind]) for kind in kinds))
+        code += f"""
+        if len(rules) != {len(guards)}:  # rules were added or removed since translation
+            for n, rule in enumerate(rules):
+                if {' and '.join(f'{held[kind]}[n]' for kind in kinds)}:
+                    rule(self)
+            return"""
+    else:
+        code += f"""
+        if len(rules) != {len(guards)}:  # rules were added or removed since translation
+            for rule in rules:
+                rule(self)
+            return"""
+    code += f"""
+        {', '.join(names)}{',' if len(names) == 1 else ''} = rules"""
+    if not all(always for always, _ in guards):
+        code += """
+        active = model.active_rules"""
+    code += ''.join(f"""
+        clock_{n} = model.clocks[{counter!r}]""" for n, (counter, _, _, _) in sorted(timers.items()))
+    code += ''.join(f"""
+        match_{n} = None""" for n in sorted(shared.values()))
+    if sparse is not None:
+        code += """
+        awake = False  # whether any active rule could apply to this agent"""
+    for n, (r, (always, key)) in enumerate(zip(names, guards)):
+        apply = [f'{r}.apply(model, self, time, time)']
+        if n in timers:
+            apply = [f'if not model._defer(self, {n}):', '    ' + apply[0]]
+        if sparse is not None:
+            apply.insert(0, 'awake = True')
+        checks = [] if always else [f'active[{n}]']
+        if n in timers:
+            checks.insert(0, f'self not in clock_{n}')
+        checks += met(n)
+        if key in shared:
+            match = f'match_{shared[key]}'
+            lines = [f'if {match} is None:', f'    {match} = rule_{shared[key]}.group_qry.match(self)',
+                     f'if {match}:'] + ['    ' + line for line in apply]
+            if checks:
+                code += indent([f"if {' and '.join(checks)}:"] + ['    ' + line for line in lines], 2)
+            else:
+                code += indent(lines, 2)
+            continue
+        if key is not None:
+            checks.append(f'{r}.group_qry.match(self)')
+        if checks:
+            code += indent([f"if {' and '.join(checks)}:"] + ['    ' + line for line in apply], 2)
+        else:
+            code += indent(apply, 2)
+    if sparse is not None:
+        # a rule whose conditions may read more than the agent still applies to it if its attributes and relations do
+        filters = ''.join(f" and not ({' and '.join(([] if always else [f'active[{n}]']) + met(n))}"
+                          f"{' and ' if not always or met(n) else ''}model.rule_filters[{n}](self))"
+                          for n, ((always, _), kind) in enumerate(zip(guards, sparse)) if kind == 'filter')
+        code += f"""
+        if not awake{filters}:
+            model.schedule.park(self)"""
+    return code
+
+
 def _extract_imports(file: str) -> List[str]:
     """
     A rudimentary function that searches a file for top-level import or from..import statements.
@@ -3,11 +3,12 @@ The RuleWriter class contains all the logic for transforming PyPRAM rules into r
 """
 
 import ast
-from ast import Add, And, Assign, Attribute, AugAssign, BinOp, BoolOp, Call, ClassDef, Compare, Constant, Dict, \
-                DictComp, Eq, Expr, For, FunctionDef, GeneratorExp, If, IfExp, In, Index, Lambda, List, ListComp, \
-                Load, Lt, LtE, Module, Name, NodeTransformer, Not, Return, Store, Subscript, Tuple, UnaryOp, With, \
-                arg, arguments, comprehension, withitem
+from ast import Add, And, Assign, Attribute, AugAssign, BinOp, BoolOp, Call, ClassDef, Compare, Constant, Del, \
+                Dict, DictComp, Eq, Expr, For, FunctionDef, GeneratorExp, If, IfExp, In, Index, Is, IsNot, Lambda, \
+                List, ListComp, Load, Lt, LtE, Module, Name, NodeTransformer, Not, NotEq, Return, Set, Store, Sub, \
+                Subscript, Tuple, UnaryOp, With, arg, arguments, comprehension, keyword, withitem
 
+import collections
 import warnings
 from typing import Any, Optional, Union, Sequence
 
@@ -20,10 +21,44 @@ class RuleWriter(NodeTransformer):
     # a list containing all the functions that require special functions to be added to the agent or model
     customs = ('copy', 'get_mass', 'has_attr', 'ha', 'has_rel', 'has_sites', 'hr', 'matches_qry', 'ga', 'get_attr',
                'get_groups', 'get_group', 'get_groups_mass', 'get_groups_mass_prop', 'get_groups_mass_and_prop')
-
-    def __init__(self):
+    # functions taking attribute or relation names, and the position of the name(s) in their translated calls
+    name_args = {'get_attr': 1, 'ga': 1, 'get_rel': 0, 'gr': 0, 'set_attr': 0, 'set_rel': 0, 'has_attr': 0, 'ha': 0,
+                 'has_rel': 0, 'hr': 0, 'has_sites': 0}
+    # functions whose calls with a literal argument are specialized into direct comparisons (see _inline_has)
+    inlined = ('has_attr', 'ha', 'has_rel', 'hr')
+    # translated functions that read other agents' attributes and relations through a group query
+    aggregates = ('get_mass', 'get_mass_prop', 'get_mass_and_prop', 'get_groups', 'get_group', 'get_groups_mass',
+                  'get_groups_mass_prop', 'get_groups_mass_and_prop')
+    # stands for any attribute or relation in the access sets of rules (see _record_access)
+    ANY = '*'
+    # what a value computed in a rule's apply depends on, from least to most (see _hoist): literals, the time, the
+    # rule's unchanged attributes and queries of the whole model; also the agent's position; also its other data; more
+    GLOBAL, SITE, STATE, AGENT = range(4)
+    # builtins whose results depend on nothing but their arguments
+    pure = ('abs', 'bool', 'float', 'int', 'len', 'max', 'min', 'round', 'str')
+
+    def __init__(self, hoisting: bool = True, specialize: bool = True):
+        """
+        :param hoisting: Should rules compute the values that are the same for every agent once per step (see _hoist)?
+        :param specialize: Should literal has_attr and has_rel calls, and the GroupQry conditions made of them, be
+                           turned into direct comparisons (see _inline_has and _fold_conditions)?
+        """
+        self.hoisting = hoisting
+        self.specialize = specialize
         self.used = set()  # which functions from customs are actually used?
         self.rule_names = []  # a list of rules that were processed
+        self.gss_keys = set()  # names of attributes and relations set or deleted in GroupSplitSpecs
+        self.gss_values = []  # (name, value) pairs of attributes set to constants in GroupSplitSpecs
+        self.names = set()  # original names of all attributes and relations named by string constants in the rules
+        self.access = {}  # {rule class name: (own reads, sets, deletes, reads of other agents)}; see _record_access
+        self.timers = {}  # {rule class name: (tested counter, value it fires at, steps of counters)}; see _record_timer
+        # {rule class name: ((attribute, relation names), (names of the rule's own attributes holding attribute,
+        # relation names) its is_applicable requires, whether it also requires what its base classes' does)}; see
+        # _record_requirements
+        self.requirements = {}
+        # {rule class name: [(method name, names of the values it computes once per step, whether once per site)]}; see
+        # _hoist
+        self.hoisted = {}
 
     def visit_Module(self, node: Module) -> Any:
         """
@@ -51,14 +86,20 @@ class RuleWriter(NodeTransformer):
         :param node: A ClassDef node; likely a PyPRAM Rule
         :return: a processed node
         """
+        self._record_requirements(node)
         self.generic_visit(node)
         self.rule_names.append(node.name)
+        self._record_access(node)
+        self._record_timer(node)
+        if self.hoisting:
+            self._hoist(node)
         bases = [] if any([isinstance(n, FunctionDef) and n.name == 'apply' for n in node.body]) else node.bases
         node.body.append(FunctionDef(
             name='__call__',
             args=arguments(
                 args=[
-                    arg(arg='self', annotation=None)
+                    arg(arg='self', annotation=None),
+                    arg(arg='agent', annotation=None)
                 ],
                 posonlyargs=[],
                 kwonlyargs=[],
@@ -73,11 +114,9 @@ class RuleWriter(NodeTransformer):
                         op=Not(),
                         operand=Call(
                             func=Attribute(
-                                value=Name(id='self', ctx=Load()),
-                                attr=Attribute(
-                                    value=Name(id='agent', ctx=Load()),
-                                    attr='matches_qry'
-                                )
+                                value=Name(id='agent', ctx=Load()),
+                                attr='matches_qry',
+                                ctx=Load()
                             ),
                             args=[Attribute(
                                 value=Name(id='self', ctx=Load()),
@@ -274,8 +313,9 @@ class RuleWriter(NodeTransformer):
 
     def visit_FunctionDef(self, node: FunctionDef) -> Any:
         """
-        Edits an __init__ function definition, allowing the Rule to be bound to an agent and model, and attempting to
-        read rule data from the relevant JSON file
+        Edits an __init__ function definition, allowing the Rule to be bound to a model, and attempting to read rule
+        data from the relevant JSON file. Rules are built once per model (not once per agent), so this file is only read
+        and the group_qry's conditions are only unpickled once per rule.
         :param node: A FunctionDef node
         :return: If node represents an __init__ function, returns node processed as described above.
                  Otherwise, returns node with all child nodes handled
@@ -289,7 +329,7 @@ class RuleWriter(NodeTransformer):
             args=arguments(
                 args=[
                     arg(arg='self', annotation=None),
-                    arg(arg='agent', annotation=None)
+                    arg(arg='model', annotation=None)
                 ],
                 posonlyargs=[],
                 kwonlyargs=[],
@@ -299,25 +339,13 @@ class RuleWriter(NodeTransformer):
                 kw_defaults=None
             ),
             body=[
-                Assign(
-                    targets=[Attribute(
-                        value=Name(id='self', ctx=Load()),
-                        attr='agent',
-                        ctx=Store()
-                    )],
-                    value=Name(id='agent', ctx=Load())
-                ),
                 Assign(
                     targets=[Attribute(
                         value=Name(id='self', ctx=Load()),
                         attr='model',
                         ctx=Store()
                     )],
-                    value=Attribute(
-                        value=Name(id='agent', ctx=Load()),
-                        attr='model',
-                        ctx=Load()
-                    )
+                    value=Name(id='model', ctx=Load())
                 ),
                 With(
                     items=[withitem(
@@ -483,12 +511,26 @@ class RuleWriter(NodeTransformer):
             #                 f"but was of type {type(node.func)}")  # TODO: check if we should be raising an error here
             fname = ''
 
+        if fname == 'GroupQry' and self.specialize:
+            node = RuleWriter._fold_conditions(node)
+            self._safe_names(RuleWriter._get_argument(node, 0, 'attr'))
+            self._safe_names(RuleWriter._get_argument(node, 1, 'rel'))
+
         f = RuleWriter.lookup.get(fname, None)
         if f:  # don't do anything with a function not listed here
             if fname in RuleWriter.customs:
                 self.used.add(fname)
 
-            return f(node)
+            pos = RuleWriter.name_args.get(fname)
+            if fname in RuleWriter.inlined and self.specialize:
+                # the specialized comparisons name the attributes directly, so they must be python-safe beforehand
+                self._safe_names(RuleWriter._get_argument(node, pos, 'qry'))
+                pos = None
+            elif fname in RuleWriter.inlined:
+                f = RuleWriter._unspecialized
+            node = f(node)
+            if pos is not None and isinstance(node, Call) and len(node.args) > pos:
+                self._safe_names(node.args[pos])
 
         return node
 
@@ -566,7 +608,7 @@ class RuleWriter(NodeTransformer):
 
             # special case for single value collections (i.e. probability 1)
             if len(node.value.elts) == 1:
-                calls, _ = RuleWriter._parse_gss_call(node.value.elts[0])
+                calls, _ = self._parse_gss_call(node.value.elts[0])
                 return calls
 
             cml_probs = []
@@ -592,7 +634,7 @@ class RuleWriter(NodeTransformer):
             for elt in node.value.elts[:-1]:
                 # elt is (should be) a Call node creating a GroupSplitSpec object
                 calls = []
-                c, p = RuleWriter._parse_gss_call(elt)
+                c, p = self._parse_gss_call(elt)
                 calls.extend(c)
                 cml_probs.append(p)
 
@@ -601,7 +643,7 @@ class RuleWriter(NodeTransformer):
                 orelse = []
                 if elt == node.value.elts[-2]:  # the second to last node becomes an if/else
                     # process node.value.elts[-1] as orelse section
-                    orelse, _ = RuleWriter._parse_gss_call(node.value.elts[-1])  # ignore p
+                    orelse, _ = self._parse_gss_call(node.value.elts[-1])  # ignore p
 
                 ifs.append(If(
                     test=Compare(
@@ -623,7 +665,7 @@ class RuleWriter(NodeTransformer):
                     and node.value.elt.func.id == 'GroupSplitSpec'):
                 return node
 
-            calls, p = RuleWriter._parse_gss_call(node.value.elt)
+            calls, p = self._parse_gss_call(node.value.elt)
 
             statements = [
                 Assign(
@@ -687,7 +729,7 @@ class RuleWriter(NodeTransformer):
     @staticmethod
     def _apply_call() -> Call:
         """
-        A shorthand method for `self.apply(self.model, self.agent, self.model.time, self.model.time)`
+        A shorthand method for `self.apply(self.model, agent, self.model.time, self.model.time)`
         :return: A Call node equivalent to the above line
         """
         return Call(
@@ -702,11 +744,7 @@ class RuleWriter(NodeTransformer):
                     attr='model',
                     ctx=Load()
                 ),
-                Attribute(
-                    value=Name(id='self', ctx=Load()),
-                    attr='agent',
-                    ctx=Load()
-                ),
+                Name(id='agent', ctx=Load()),
                 Attribute(
                     value=Attribute(
                         value=Name(id='self', ctx=Load()),
@@ -770,11 +808,11 @@ class RuleWriter(NodeTransformer):
             return p
         return RuleWriter._get_ancestor(p, type)
 
-    @staticmethod
-    def _parse_gss_call(elt: Call) -> typing.Tuple[typing.List, Optional[Any]]:
+    def _parse_gss_call(self, elt: Call) -> typing.Tuple[typing.List, Optional[Any]]:
         """
         Translates a GroupSplitSpec definition Call into a series of Calls to set and delete, followed by a Return.
-        Also returns the probability value.
+        Also returns the probability value, records any constant attribute or relation names in self.gss_keys, and
+        records attributes set to constant values in self.gss_values.
         :param elt: A Call node, hopefully calling a GroupSplitSpec initialization
         :return: A tuple containing a list of Call nodes, and a node representing the probability that those calls
                  should occur at
@@ -821,6 +859,10 @@ class RuleWriter(NodeTransformer):
                 #         keywords=[]
                 #     )))
 
+                self._record_keys(kw.value.keys)
+                if kw.arg.startswith('attr'):
+                    self._record_values(kw.value.keys, kw.value.values)
+                self._safe_names(kw.value)
                 calls.extend([Expr(Call(
                     func=Attribute(
                         value=Name(id='group', ctx=Load()),
@@ -828,12 +870,14 @@ class RuleWriter(NodeTransformer):
                     ),
                     args=[
                         key,
-                        value
+                        RuleWriter._site_ref(value) if kw.arg.startswith('rel') else value
                     ],
                     keywords=[]
                 )) for key, value in zip(kw.value.keys, kw.value.values)])
             if kw.arg.endswith("del"):
                 # kw.value is (should be) a Set node
+                self._record_keys(kw.value.elts)
+                self._safe_names(kw.value)
                 calls.extend([Expr(Call(
                     func=Attribute(
                         value=Name(id='group', ctx=Load()),
@@ -848,6 +892,647 @@ class RuleWriter(NodeTransformer):
         calls.append(Return(value=None))
         return calls, p
 
+    def _record_access(self, node: ClassDef) -> None:
+        """
+        Records in self.access which names a translated rule reads of its own agent (group), sets, deletes, and reads of
+        other agents (through group queries or anything given pop), for _write_mode in pram2mesa. RuleWriter.ANY stands
+        for names not known at translation time.
+        :param node: A translated ClassDef node
+        """
+        any_ = RuleWriter.ANY
+        reads, sets, dels, queries = set(), set(), set(), set()
+        methods = {n.name for n in node.body if isinstance(n, FunctionDef)}
+
+        def name_of(key):
+            if isinstance(key, Constant) and isinstance(key.value, str):
+                return 'pos' if key.value == '@' else mpi(key.value)
+            if isinstance(key, Attribute) and isinstance(key.value, Name) and \
+                    (key.value.id, key.attr) == ('Site', 'AT'):
+                return 'pos'  # Site.AT is replaced with '@' once the rules are written out
+            return any_
+
+        def is_group(n):
+            return isinstance(n, Name) and n.id == 'group'
+
+        # __init__ and __call__ are written by the translator (see visit_FunctionDef and visit_ClassDef)
+        body = [n for n in node.body if not (isinstance(n, FunctionDef) and n.name in ('__init__', '__call__'))]
+        for n in (n for b in body for n in ast.walk(b)):
+            if isinstance(n, Attribute) and n.attr == 'pos':
+                (reads if is_group(n.value) else queries).add('pos')
+                continue
+            if not isinstance(n, Call):
+                continue
+            if isinstance(n.func, Attribute):
+                fname, owner = n.func.attr, n.func.value
+            else:
+                fname, owner = getattr(n.func, 'id', ''), None
+
+            if fname in ('set', 'delete') and owner is not None and n.args:
+                if is_group(owner):
+                    (sets if fname == 'set' else dels).add(name_of(n.args[0]))
+                else:  # a change to another agent, which any rule could be reading
+                    sets.add(any_)
+                    queries.add(any_)
+            elif fname == 'get' and isinstance(owner, Name) and n.args:  # not e.g. self.tm.get, a dict's
+                (reads if is_group(owner) else queries).add(name_of(n.args[0]))
+            elif fname == 'get_attr' and len(n.args) == 2:
+                (reads if is_group(n.args[0]) else queries).add(name_of(n.args[1]))
+            elif fname == 'GroupQry':
+                for qry in (RuleWriter._get_argument(n, 0, 'attr'), RuleWriter._get_argument(n, 1, 'rel')):
+                    if isinstance(qry, Dict):
+                        queries.update(name_of(k) for k in qry.keys)
+                    elif not (isinstance(qry, Constant) and qry.value is None):
+                        queries.add(any_)
+                full = RuleWriter._get_argument(n, 3, 'full')
+                if not (isinstance(full, Constant) and not full.value):
+                    queries.add(any_)  # a full query looks at every name agents hold
+                # conditions are lambdas, whose reads (e.g. g.get(...)) are found as reads of other agents
+            elif fname in RuleWriter.aggregates:
+                queries.add('pos')  # the mass of a site depends on which agents are at it
+                qry = n.args[-1] if n.args else None
+                if not (isinstance(qry, Constant) and qry.value is None or
+                        isinstance(qry, Call) and getattr(qry.func, 'id', '') == 'GroupQry'):
+                    queries.add(any_)
+            elif fname in ('copy', 'add_vita_group', 'add_group', 'add_groups'):
+                reads.add(any_)  # a copy takes every attribute and relation of the agent
+            elif fname in methods and (isinstance(owner, Name) and owner.id == 'self' or isinstance(owner, Call)):
+                pass  # a method of the rule itself (or super()), which is searched as part of node
+            else:
+                # any other function given the agent or the population may read anything from it
+                args = list(n.args) + [kw.value for kw in n.keywords]
+                if any(isinstance(a, Name) and a.id == 'pop' for a in args):
+                    queries.add(any_)
+                if any(is_group(a) for a in args) or is_group(owner):
+                    reads.add(any_)
+        self.access[node.name] = (reads, sets, dels, queries)
+
+    def _record_timer(self, node: ClassDef) -> None:
+        """
+        Records in self.timers whether a translated rule's apply is a timer: a test of an attribute against a literal
+        int, where every other outcome only steps counters (attributes set to their own value plus a literal int), such
+        as `if group.has_attr({'incubation': 0}): ... else: incubation - 1` (see _timer_rules in pram2mesa).
+        :param node: A translated ClassDef node
+        """
+        apply = next((n for n in node.body if isinstance(n, FunctionDef) and n.name == 'apply'), None)
+        if apply is None or len(apply.args.args) < 3:
+            return
+        pop, group = apply.args.args[1].arg, apply.args.args[2].arg
+        body = [n for n in apply.body if not (isinstance(n, Expr) and isinstance(n.value, Constant))]  # docstrings
+        if not body or not isinstance(body[0], If):
+            return
+        test, expiry, rest = body[0].test, body[0].body, body[0].orelse
+        if rest and len(body) > 1 or not rest and not RuleWriter._returns(expiry):
+            return  # the rest of the rule must only be reached if the test fails
+        rest = rest or body[1:]
+
+        def is_group(n):
+            return isinstance(n, Name) and n.id == group
+
+        def name_read(n):  # the name of the group's attribute read by n, such as pop.get_attr(group, 'incubation')
+            if not isinstance(n, Call) or not isinstance(n.func, Attribute) or n.keywords:
+                return None
+            if n.func.attr == 'get_attr' and isinstance(n.func.value, Name) and n.func.value.id == pop and \
+                    len(n.args) == 2 and is_group(n.args[0]):
+                key = n.args[1]
+            elif n.func.attr == 'get' and is_group(n.func.value) and n.args:
+                key = n.args[0]
+            else:
+                return None
+            return key.value if isinstance(key, Constant) and isinstance(key.value, str) else None
+
+        def is_int(n):
+            return isinstance(n, Constant) and type(n.value) is int
+
+        if not (isinstance(test, Compare) and len(test.ops) == 1 and isinstance(test.ops[0], Eq) and
+                is_int(test.comparators[0]) and name_read(test.left)):
+            return
+        steps = {}
+        for n in rest:
+            if isinstance(n, Return) and n.value is None and n is rest[-1]:
+                continue
+            call = n.value if isinstance(n, Expr) else None
+            if not (isinstance(call, Call) and isinstance(call.func, Attribute) and call.func.attr == 'set' and
+                    is_group(call.func.value) and len(call.args) == 2 and not call.keywords):
+                return
+            key, value = call.args
+            if not (isinstance(key, Constant) and isinstance(value, BinOp) and isinstance(value.op, (Add, Sub)) and
+                    is_int(value.right) and value.right.value and name_read(value.left) == key.value):
+                return
+            if key.value in steps:
+                return
+            steps[key.value] = value.right.value if isinstance(value.op, Add) else -value.right.value
+        counter = name_read(test.left)
+        if counter in steps:
+            self.timers[node.name] = (counter, test.comparators[0].value, tuple(steps.items()))
+
+    def _hoist(self, node: ClassDef) -> None:
+        """
+        Has a translated rule compute the values that are the same for every agent in a step (GLOBAL) or at a site
+        (SITE) once, by the first agent to reach them, and keep them in the rule for the others (see _hoist_method).
+        Runs found are recorded in self.hoisted.
+        :param node: A translated ClassDef node
+        """
+        # nodes built by the other methods of the writer may lack a context, which what follows relies on
+        targets = {id(target) for s in ast.walk(node) if isinstance(s, (Assign, AugAssign, For, comprehension))
+                   for target in (s.targets if isinstance(s, Assign) else [s.target])}
+        targets |= {id(n) for s in ast.walk(node) if isinstance(s, (Tuple, List)) and id(s) in targets for n in s.elts}
+        for n in ast.walk(node):
+            if isinstance(n, (Name, Attribute, Subscript, Tuple, List)) and not hasattr(n, 'ctx'):
+                n.ctx = Store() if id(n) in targets else Load()
+        # the rule's own attributes that any of its methods may change: assigned, deleted, indexed into or called upon
+        changed = set()
+        for n in ast.walk(node):
+            if isinstance(n, Attribute) and isinstance(n.ctx, (Store, Del)):
+                target = n
+            elif isinstance(n, Subscript) and isinstance(n.ctx, (Store, Del)):
+                target = n.value
+            elif isinstance(n, Call) and isinstance(n.func, Attribute):
+                target = n.func.value
+            else:
+                continue
+            if isinstance(target, Attribute) and isinstance(target.value, Name) and target.value.id == 'self':
+                changed.add(target.attr)
+        runs = []
+        for method in node.body:
+            if isinstance(method, FunctionDef) and len(method.args.args) >= 5 and not method.args.vararg:
+                runs += self._hoist_method(method, changed, len(runs))
+        if not runs:
+            return
+        self.hoisted[node.name] = runs
+        node.body[:0] = [Assign(targets=[Name(id=name, ctx=Store())], value=Constant(value=None))
+                         for name in ('_hoisted_time', '_hoisted')]
+
+    def _hoist_method(self, method: FunctionDef, changed: typing.Set[str], first: int) -> typing.List[typing.Tuple]:
+        """
+        Hoists the runs of statements of one method of a rule that compute GLOBAL or SITE values (see _hoist).
+        :param method: A translated FunctionDef node taking (self, pop, group, iter, t, ...)
+        :param changed: The rule's own attributes that any of its methods may change
+        :param first: The number of runs already hoisted in the rule, by which this method's are numbered
+        :return: A list of (method name, names of the values each run computes, whether once per site)
+        """
+        GLOBAL, SITE, STATE, AGENT = RuleWriter.GLOBAL, RuleWriter.SITE, RuleWriter.STATE, RuleWriter.AGENT
+        rule, pop, group, it, t = (a.arg for a in method.args.args[:5])
+        params = {a.arg for a in method.args.args + method.args.kwonlyargs}
+        def count(statements):
+            return collections.Counter(n.id for s in statements for n in ast.walk(s)
+                                       if isinstance(n, Name) and isinstance(n.ctx, (Store, Del)))
+
+        stores = count([method])
+        loads = collections.Counter(n.id for n in ast.walk(method) if isinstance(n, Name) and isinstance(n.ctx, Load))
+        values = '_values'
+        while values in stores or values in params:
+            values += '_'
+        # get_groups calls whose agents are only counted or tested, and variables only used so
+        counted = set()
+        for n in ast.walk(method):
+            if isinstance(n, Call) and isinstance(n.func, Name) and n.func.id == 'len' and len(n.args) == 1:
+                counted.add(id(n.args[0]))
+            elif isinstance(n, (If, IfExp)) or isinstance(n, UnaryOp) and isinstance(n.op, Not):
+                counted.add(id(n.operand if isinstance(n, UnaryOp) else n.test))
+            elif isinstance(n, BoolOp):
+                counted.update(id(v) for v in n.values)
+        counted_names = {name for name in loads
+                         if all(id(n) in counted for n in ast.walk(method)
+                                if isinstance(n, Name) and n.id == name and isinstance(n.ctx, Load))}
+        env = {}  # the dependence of the variables assigned once, as (level, names of variables holding positions)
+
+        def is_group(n):
+            return isinstance(n, Name) and n.id == group
+
+        def is_key(n):  # a literal attribute or relation name, Site.AT being replaced by '@' in the written code
+            return isinstance(n, Constant) or isinstance(n, Attribute) and isinstance(n.value, Name) and \
+                n.value.id == 'Site' and n.attr == 'AT'
+
+        def is_position(n):  # group.get('@') (or 'pos'), with or without a default
+            return isinstance(n, Call) and isinstance(n.func, Attribute) and n.func.attr == 'get' and \
+                is_group(n.func.value) and 1 <= len(n.args) <= 2 and not n.keywords and is_key(n.args[0]) and \
+                (n.args[0].value if isinstance(n.args[0], Constant) else '@') in ('@', 'pos')
+
+        def combine(nodes):
+            found = [dependence(n) for n in nodes]
+            return max((level for level, _ in found), default=GLOBAL), frozenset().union(*(keys for _, keys in found))
+
+        def query(n):  # a GroupQry of literal keys and values, without conditions
+            if isinstance(n, Constant) and n.value is None:
+                return GLOBAL, frozenset()
+            if not (isinstance(n, Call) and isinstance(n.func, Name) and n.func.id == 'GroupQry' and
+                    n.func.id not in stores):
+                return AGENT, frozenset()
+            attr, rel = RuleWriter._get_argument(n, 0, 'attr'), RuleWriter._get_argument(n, 1, 'rel')
+            cond, full = RuleWriter._get_argument(n, 2, 'cond'), RuleWriter._get_argument(n, 3, 'full')
+            parts = []
+            for qry in (attr, rel):
+                if isinstance(qry, Dict) and all(is_key(k) for k in qry.keys):
+                    parts += qry.values
+                elif not (isinstance(qry, Constant) and qry.value is None):
+                    return AGENT, frozenset()
+            if not (isinstance(cond, List) and not cond.elts or isinstance(cond, Constant) and cond.value is None):
+                return AGENT, frozenset()
+            if not isinstance(full, Constant):
+                return AGENT, frozenset()
+            return combine(parts)
+
+        def dependence(n):
+            if isinstance(n, Constant):
+                return GLOBAL, frozenset()
+            if isinstance(n, Name):
+                if n.id in (t, it) and not stores[n.id]:
+                    return GLOBAL, frozenset()
+                return env.get(n.id, (AGENT, frozenset()))
+            if isinstance(n, Attribute):
+                if isinstance(n.value, Name) and n.value.id == rule and n.attr not in changed:
+                    return GLOBAL, frozenset()
+                return AGENT, frozenset()
+            if isinstance(n, BinOp):
+                return combine([n.left, n.right])
+            if isinstance(n, UnaryOp):
+                return dependence(n.operand)
+            if isinstance(n, BoolOp):
+                return combine(n.values)
+            if isinstance(n, Compare):
+                return combine([n.left] + n.comparators)
+            if isinstance(n, IfExp):
+                return combine([n.test, n.body, n.orelse])
+            if not isinstance(n, Call) or n.keywords or any(isinstance(a, ast.Starred) for a in n.args):
+                return AGENT, frozenset()
+            if isinstance(n.func, Name):
+                if n.func.id in RuleWriter.pure and n.func.id not in stores and n.func.id not in params:
+                    return combine(n.args)
+                return AGENT, frozenset()
+            if not isinstance(n.func, Attribute):
+                return AGENT, frozenset()
+            if is_group(n.func.value) and n.func.attr == 'get':
+                return STATE, frozenset()
+            if not (isinstance(n.func.value, Name) and n.func.value.id == pop and stores[pop] == 0):
+                return AGENT, frozenset()
+            if n.func.attr == 'get_attr' and len(n.args) == 2 and is_group(n.args[0]):
+                return STATE, frozenset()
+            if n.func.attr in ('get_groups_mass', 'get_groups_mass_prop', 'get_groups_mass_and_prop') and \
+                    len(n.args) <= 1:
+                return query(n.args[0]) if n.args else (GLOBAL, frozenset())
+            if n.func.attr in ('get_mass', 'get_mass_prop', 'get_mass_and_prop', 'get_groups') and \
+                    1 <= len(n.args) <= 2:
+                target, qry = n.args[0], n.args[1] if len(n.args) == 2 else Constant(value=None)
+                if is_group(target):
+                    return STATE, frozenset()
+                level, keys = (GLOBAL, frozenset()) if isinstance(target, Name) and target.id == pop else \
+                    dependence(target)
+                qry_level, qry_keys = query(qry)
+                return max(level, qry_level), keys | qry_keys
+            return AGENT, frozenset()
+
+        def assigned(statements):  # the variables a list of statements assigns on every path through it
+            found = set()
+            for statement in statements:
+                if isinstance(statement, Assign):
+                    found.add(statement.targets[0].id)
+                elif isinstance(statement, If):
+                    found |= assigned(statement.body) & assigned(statement.orelse)
+            return found
+
+        def hoistable(statement, scope=None):
+            """
+            The dependence of a statement, if it only assigns values to local variables; otherwise None. Each variable
+            must be assigned nowhere else in the method than in the outermost statement being considered (scope).
+            """
+            scope = scope or count([statement])
+            if isinstance(statement, Assign) and len(statement.targets) == 1 and \
+                    isinstance(statement.targets[0], Name):
+                name = statement.targets[0].id
+                if name in params or stores[name] != scope[name]:
+                    return None
+                if is_position(statement.value):  # the agent's position, on which SITE values depend
+                    env[name] = (SITE, frozenset([name]))
+                    return None
+                found = env[name] = dependence(statement.value)
+                for n in ast.walk(statement.value):
+                    if isinstance(n, Call) and isinstance(n.func, Attribute) and n.func.attr == 'get_groups' and \
+                            not (id(n) in counted or n is statement.value and name in counted_names):
+                        env[name] = (AGENT, frozenset())
+                        return None
+                return found
+            if isinstance(statement, If) and statement.orelse:
+                inner = [hoistable(s, scope) for s in statement.body + statement.orelse]
+                if None in inner:
+                    return None
+                names = count([statement])
+                found = combine([statement.test])
+                level = max([found[0]] + [level for level, _ in inner])
+                keys = found[1].union(*(keys for _, keys in inner))
+                for name in names:
+                    env[name] = (level, keys)
+                return level, keys
+            return None
+
+        runs = []
+
+        def hoist(run):
+            """The statements computing a run of hoistable statements once per step (and site)"""
+            names = sorted(assigned(s for s, _ in run))
+            inside = collections.Counter(n.id for s, _ in run for n in ast.walk(s)
+                                         if isinstance(n, Name) and isinstance(n.ctx, Load))
+            every = collections.Counter(n.id for s, _ in run for n in ast.walk(s)
+                                        if isinstance(n, Name) and isinstance(n.ctx, Store))
+            # variables assigned on some paths only must not be needed after the run
+            if any(loads[name] > inside[name] for name in every if name not in names):
+                return [s for s, _ in run]
+            # only worth it if the run computes something
+            if not names or not any(isinstance(n, (Call, BinOp)) for s, _ in run for n in ast.walk(s)):
+                return [s for s, _ in run]
+            keys = sorted(frozenset().union(*(keys for _, (_, keys) in run)))
+            number = first + len(runs)
+            runs.append((method.name, tuple(names), bool(keys)))
+
+            def kept():
+                return Attribute(value=Name(id=rule, ctx=Load()), attr='_hoisted', ctx=Load())
+
+            key = Tuple(elts=[Constant(value=number)] + [Name(id=k, ctx=Load()) for k in keys], ctx=Load())
+            return [
+                Assign(targets=[Name(id=values, ctx=Store())],
+                       value=Call(func=Attribute(value=kept(), attr='get', ctx=Load()), args=[key], keywords=[])),
+                If(
+                    test=Compare(left=Name(id=values, ctx=Load()), ops=[Is()], comparators=[Constant(value=None)]),
+                    body=[s for s, _ in run] + [
+                        Assign(targets=[Subscript(value=kept(), slice=Index(value=key), ctx=Store())],
+                               value=Tuple(elts=[Name(id=name, ctx=Load()) for name in names], ctx=Load()))
+                    ],
+                    orelse=[
+                        Assign(targets=[Tuple(elts=[Name(id=name, ctx=Store()) for name in names], ctx=Store())],
+                               value=Name(id=values, ctx=Load()))
+                    ]
+                )
+            ]
+
+        def block(statements):
+            processed, run = [], []
+            for statement in statements:
+                found = hoistable(statement)
+                if found is not None and found[0] <= SITE:
+                    run.append((statement, found))
+                    continue
+                if run:
+                    processed += hoist(run)
+                    run = []
+                for field in ('body', 'orelse', 'finalbody'):
+                    inner = getattr(statement, field, None)
+                    if isinstance(inner, list) and inner and isinstance(inner[0], ast.stmt):
+                        setattr(statement, field, block(inner))
+                for handler in getattr(statement, 'handlers', ()):
+                    handler.body = block(handler.body)
+                processed.append(statement)
+            if run:
+                processed += hoist(run)
+            return processed
+
+        if stores[t] or stores[rule]:
+            return []
+        method.body = block(method.body)
+        if runs:  # values kept from a previous step are dropped
+            method.body.insert(0, If(
+                test=Compare(left=Attribute(value=Name(id=rule, ctx=Load()), attr='_hoisted_time', ctx=Load()),
+                             ops=[NotEq()], comparators=[Name(id=t, ctx=Load())]),
+                body=[
+                    Assign(targets=[Attribute(value=Name(id=rule, ctx=Load()), attr='_hoisted_time', ctx=Store())],
+                           value=Name(id=t, ctx=Load())),
+                    Assign(targets=[Attribute(value=Name(id=rule, ctx=Load()), attr='_hoisted', ctx=Store())],
+                           value=Dict(keys=[], values=[]))
+                ],
+                orelse=[]
+            ))
+        return runs
+
+    def _record_requirements(self, node: ClassDef) -> None:
+        """
+        Records in self.requirements the names a rule's is_applicable requires agents to hold: those of the has_attr and
+        has_rel calls on its group among the operands of the `and` it returns (literals or attributes of the rule). Must
+        be called before the rule is translated, which inlines such calls (see _inline_has).
+        :param node: An untranslated ClassDef node
+        """
+        method = next((n for n in node.body if isinstance(n, FunctionDef) and n.name == 'is_applicable'), None)
+        if method is None or len(method.args.args) < 2:
+            return
+        group = method.args.args[1].arg
+        body = [n for n in method.body if not (isinstance(n, Expr) and isinstance(n.value, Constant))]  # docstrings
+        if len(body) != 1 or not isinstance(body[0], Return) or body[0].value is None:
+            return
+        test = body[0].value
+        operands = test.values if isinstance(test, BoolOp) and isinstance(test.op, And) else [test]
+        names, fields, inherits = (set(), set()), (set(), set()), False
+
+        def key_of(n, kind):  # the set a name belongs in, and the name, or None
+            if isinstance(n, Constant) and isinstance(n.value, str):
+                return names[kind], n.value
+            if isinstance(n, Attribute) and isinstance(n.value, Name):
+                if n.value.id == 'self':
+                    return fields[kind], n.attr
+                if n.value.id == 'Site' and n.attr == 'AT':
+                    return names[kind], '@'
+            return None
+
+        for n in operands:
+            if not isinstance(n, Call) or not isinstance(n.func, Attribute):
+                continue
+            if n.func.attr == 'is_applicable' and isinstance(n.func.value, Call) and \
+                    getattr(n.func.value.func, 'id', None) == 'super':
+                inherits = True
+            elif isinstance(n.func.value, Name) and n.func.value.id == group and len(n.args) == 1 and \
+                    not n.keywords and n.func.attr in ('has_attr', 'ha', 'has_rel', 'hr'):
+                kind = 0 if n.func.attr in ('has_attr', 'ha') else 1
+                qry = n.args[0]
+                keys = [key_of(k, kind) for k in (qry.elts if isinstance(qry, (List, Set, Tuple)) else [qry])]
+                if None not in keys:
+                    for found, key in keys:
+                        found.add(key)
+        self.requirements[node.name] = (names, fields, inherits)
+
+    @staticmethod
+    def _returns(body: Sequence) -> bool:
+        """
+        Determines whether a list of statements always ends in a return statement.
+        :param body: A list of statement nodes
+        :return: True if every path through body returns
+        """
+        if not body:
+            return False
+        last = body[-1]
+        if isinstance(last, If):
+            return RuleWriter._returns(last.body) and RuleWriter._returns(last.orelse)
+        return isinstance(last, Return)
+
+    def _record_keys(self, keys: Sequence) -> None:
+        """
+        Adds the (python-safe) names of any string Constant nodes in keys to self.gss_keys. Position ('@') is skipped,
+        since Mesa always stores it in `pos`.
+        :param keys: A list of nodes, such as the keys of a Dict node
+        """
+        self.gss_keys.update(mpi(k.value) for k in keys
+                             if isinstance(k, Constant) and isinstance(k.value, str) and k.value != '@')
+
+    def _record_values(self, keys: Sequence, values: Sequence) -> None:
+        """
+        Adds a (python-safe name, value) pair to self.gss_values for each string Constant key set to a Constant value.
+        :param keys: A list of nodes, such as the keys of a Dict node
+        :param values: A list of nodes, such as the values of a Dict node
+        """
+        self.gss_values.extend((mpi(k.value), v.value) for k, v in zip(keys, values)
+                               if isinstance(k, Constant) and isinstance(k.value, str) and isinstance(v, Constant))
+
+    def _safe_names(self, node: Any) -> Any:
+        """
+        Rewrites string Constant nodes naming attributes or relations to their python-safe identifiers, so that the
+        translated rules need not call make_python_identifier at runtime. The original names are recorded in
+        self.names. Position ('@') is left as is.
+        :param node: A Constant node, or a Dict, List, Set or Tuple node whose keys or elements are to be rewritten.
+                     Any other node is left untouched
+        :return: the processed node
+        """
+        if isinstance(node, Constant) and isinstance(node.value, str):
+            self.names.add(node.value)
+            if node.value != '@':
+                node.value = mpi(node.value)
+        elif isinstance(node, Dict):
+            for k in node.keys:  # a key of None (i.e. **kwargs) is skipped
+                self._safe_names(k)
+        elif isinstance(node, (List, Set, Tuple)):
+            for e in node.elts:
+                self._safe_names(e)
+        return node
+
+    @staticmethod
+    def _site_ref(node: Any) -> Call:
+        """
+        Wraps a node representing the value of a relation in a call to _site, which turns the names of sites into their
+        interned SiteRefs, so that the agent can tell relations from attributes.
+        :param node: A node representing a site (or its name)
+        :return: A Call node
+        """
+        return Call(
+            func=Name(id='_site', ctx=Load()),
+            args=[node],
+            keywords=[]
+        )
+
+    @staticmethod
+    def _inline_has(node: Call) -> Any:
+        """
+        Specializes a call to has_attr or has_rel with a literal argument into direct comparisons, e.g.
+        `group.has_attr({'flu': 'i'})` into `group.get('flu', _MISSING) == 'i'`. Other calls are left as they are.
+        :param node: A Call node of has_attr or has_rel
+        :return: A Compare or BoolOp node (or Constant True, for an empty argument), or node itself
+        """
+        if not isinstance(node.func, Attribute) or not isinstance(node.func.value, Name) or \
+                len(node.args) + len(node.keywords) != 1:
+            return node
+        qry = RuleWriter._get_argument(node, 0, 'qry')
+        if isinstance(qry, Dict):
+            keys, values = qry.keys, qry.values
+        elif isinstance(qry, (List, Set, Tuple)):
+            keys, values = qry.elts, None
+        else:
+            keys, values = [qry], None
+        if not all(isinstance(k, Constant) and isinstance(k.value, str) for k in keys):
+            return node
+
+        def lookup(key):
+            return Call(
+                func=Attribute(
+                    value=Name(id=node.func.value.id, ctx=Load()),
+                    attr='get',
+                    ctx=Load()
+                ),
+                args=[
+                    Constant(value='pos' if key.value == '@' else key.value),  # Mesa stores position in pos
+                    Name(id='_MISSING', ctx=Load())
+                ],
+                keywords=[]
+            )
+
+        if values is None:
+            checks = [Compare(left=lookup(k), ops=[IsNot()], comparators=[Name(id='_MISSING', ctx=Load())])
+                      for k in keys]
+        else:
+            checks = [Compare(left=lookup(k), ops=[Eq()], comparators=[v]) for k, v in zip(keys, values)]
+        if not checks:
+            return Constant(value=True)
+        if len(checks) == 1:
+            return checks[0]
+        return BoolOp(op=And(), values=checks)
+
+    @staticmethod
+    def _unspecialized(node: Call) -> Call:
+        """Translates a call of has_attr or has_rel (or ha or hr, which are renamed) without specializing it"""
+        if isinstance(node.func, Attribute):
+            node.func.attr = {'ha': 'has_attr', 'hr': 'has_rel'}.get(node.func.attr, node.func.attr)
+        return node
+
+    @staticmethod
+    def _fold_conditions(node: Call) -> Call:
+        """
+        Moves the conditions of a GroupQry that only compare the agent's attributes with literals into its attr, e.g.
+        `GroupQry(cond=[lambda g: g.get('a', _MISSING) == 1])` into `GroupQry(attr={'a': 1}, cond=[])`, which the model
+        answers from its indexes (see the Model's query_plan). Full and non-literal queries are left as they are.
+        :param node: A translated Call node of GroupQry
+        :return: The processed node
+        """
+        attr = RuleWriter._get_argument(node, 0, 'attr')
+        rel = RuleWriter._get_argument(node, 1, 'rel')
+        cond = RuleWriter._get_argument(node, 2, 'cond')
+        full = RuleWriter._get_argument(node, 3, 'full')
+        if not isinstance(cond, List) or not (isinstance(full, Constant) and not full.value):
+            return node
+        if isinstance(attr, Constant) and attr.value is None:  # not given
+            attr = Dict(keys=[], values=[])
+        if not isinstance(attr, Dict) or \
+                not all(isinstance(k, Constant) and isinstance(k.value, str) for k in attr.keys):
+            return node
+
+        def comparisons(fn):
+            # the (key, value) pairs a condition compares the agent's attributes with, or None if it does anything else
+            if not isinstance(fn, Lambda) or len(fn.args.args) != 1 or fn.args.posonlyargs or fn.args.kwonlyargs or \
+                    fn.args.vararg or fn.args.kwarg:
+                return None
+            agent = fn.args.args[0].arg
+            checks = fn.body.values if isinstance(fn.body, BoolOp) and isinstance(fn.body.op, And) else [fn.body]
+            pairs = []
+            for check in checks:
+                if not (isinstance(check, Compare) and len(check.ops) == 1 and isinstance(check.ops[0], Eq)):
+                    return None
+                lookup, value = check.left, check.comparators[0]
+                if not (isinstance(lookup, Call) and isinstance(lookup.func, Attribute) and lookup.func.attr == 'get'
+                        and isinstance(lookup.func.value, Name) and lookup.func.value.id == agent
+                        and len(lookup.args) == 2 and not lookup.keywords
+                        and isinstance(lookup.args[0], Constant) and isinstance(lookup.args[0].value, str)
+                        and lookup.args[0].value != 'pos'  # position is a relation
+                        and isinstance(lookup.args[1], Name) and lookup.args[1].id == '_MISSING'
+                        and isinstance(value, Constant)):
+                    return None
+                pairs.append((lookup.args[0].value, value))
+            return pairs
+
+        keys, values = list(attr.keys), list(attr.values)
+        taken = {k.value for k in keys}
+        kept = []
+        for fn in cond.elts:
+            pairs = comparisons(fn)
+            names = [k for k, _ in pairs or ()]
+            # a key compared twice could not be held in attr (and such a query matches no agent anyway)
+            if not pairs or len(set(names)) < len(names) or taken & set(names):
+                kept.append(fn)
+                continue
+            taken.update(names)
+            keys += [Constant(value=k) for k in names]
+            values += [v for _, v in pairs]
+        if len(kept) == len(cond.elts):
+            return node
+
+        keywords = [keyword(arg='attr', value=Dict(keys=keys, values=values))]
+        if not (isinstance(rel, Constant) and rel.value is None):
+            keywords.append(keyword(arg='rel', value=rel))
+        keywords.append(keyword(arg='cond', value=List(elts=kept, ctx=Load())))
+        folded = ast.copy_location(Call(func=node.func, args=[], keywords=keywords), node)
+        folded.parent = getattr(node, 'parent', None)
+        return folded
+
     @staticmethod
     def _pop_or_g_model(node: Any) -> Union[Attribute, Name]:
         """
@@ -1141,13 +1826,13 @@ class RuleWriter(NodeTransformer):
     @staticmethod
     def t_ha(node):
         """
-        Translates calls to ha into equivalent calls to has_attr.
+        Translates calls to ha into equivalent calls to has_attr (specialized as in t_has_attr).
         Also, by being called, flags that a has_attr method (defined elsewhere) should be added to the Mesa Agent class.
         See has_attr for details
         :param node:
         :return:
         """
-        return Call(
+        return RuleWriter._inline_has(Call(
             func=Attribute(
                 value=node.func.value,
                 attr='has_attr',
@@ -1155,23 +1840,23 @@ class RuleWriter(NodeTransformer):
             ),
             args=node.args,
             keywords=node.keywords
-        )
+        ))
 
     @staticmethod
     def t_has_attr(node):
         """
-        This method does not change anything, but by being called, flags that a has_attr method (defined elsewhere)
-        should be added to the Mesa Agent class.
+        Specializes calls with a literal argument into direct comparisons (see _inline_has); other calls are left as
+        is. By being called, flags that a has_attr method (defined elsewhere) should be added to the Mesa Agent class.
         """
-        return node
+        return RuleWriter._inline_has(node)
 
     @staticmethod
     def t_has_rel(node):
         """
-        This method does not change anything, but by being called, flags that a has_rel method (defined elsewhere)
-        should be added to the Mesa Agent class.
+        Specializes calls with a literal argument into direct comparisons (see _inline_has); other calls are left as
+        is. By being called, flags that a has_rel method (defined elsewhere) should be added to the Mesa Agent class.
         """
-        return node
+        return RuleWriter._inline_has(node)
 
     @staticmethod
     def t_has_sites(node):
@@ -1196,13 +1881,13 @@ class RuleWriter(NodeTransformer):
     @staticmethod
     def t_hr(node):
         """
-        Translates calls to hr into equivalent calls to has_rel.
+        Translates calls to hr into equivalent calls to has_rel (specialized as in t_has_rel).
         Also, by being called, flags that a has_rel method (defined elsewhere) should be added to the Mesa Agent class.
         See has_rel for details
         :param node:
         :return:
         """
-        return Call(
+        return RuleWriter._inline_has(Call(
             func=Attribute(
                 value=node.func.value,
                 attr='has_rel',
@@ -1210,7 +1895,7 @@ class RuleWriter(NodeTransformer):
             ),
             args=node.args,
             keywords=node.keywords
-        )
+        ))
 
     @staticmethod
     def t_is_at_site(node):
@@ -1343,7 +2028,7 @@ class RuleWriter(NodeTransformer):
         Translates a call like:
             g.set_rel(name, value, do_force=bool_val)
         into a call like:
-            g.set(name, value)
+            g.set(name, _site(value))
         :param node:
         :return:
         """
@@ -1357,7 +2042,7 @@ class RuleWriter(NodeTransformer):
             ),
             args=[
                 name,
-                value
+                RuleWriter._site_ref(value)
             ],
             keywords=[]
         )
@@ -1411,7 +2096,7 @@ class RuleWriter(NodeTransformer):
             g.set_rels(rels, do_force=bool_val)
         into a call like:
             for name, value in rels.items():
-                g.set(name, value)
+                g.set(name, _site(value))
         :param node:
         :return:
         """
@@ -1442,7 +2127,7 @@ class RuleWriter(NodeTransformer):
                     ),
                     args=[
                         Name(id='name', ctx=Load()),
-                        Name(id='value', ctx=Load())
+                        RuleWriter._site_ref(Name(id='value', ctx=Load()))
                     ],
                     keywords=[]
                 )
@@ -0,0 +1,103 @@
+"""
+Rules for the tests. pram2mesa only translates rules defined in modules whose names start with 'pram' (or in
+__main__), hence the name of this module.
+"""
+
+import random
+from pram.rule import Rule, TimeAlways, IterAlways
+from pram.entity import Group, GroupQry, GroupSplitSpec
+
+
+class ExposureRule(Rule):
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('exposure', t, i, group_qry=GroupQry(attr={'flu': 's'}), memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        return [
+            GroupSplitSpec(p=0.1, attr_set={'flu': 'e', 'incubation': random.randint(2, 5)}),
+            GroupSplitSpec(p=0.9)
+        ]
+
+
+class IncubationRule(Rule):
+    # a timer: counts incubation down to 0, then makes the agent infectious
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('incubation', t, i, group_qry=GroupQry(attr={'flu': 'e'}), memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        if group.has_attr({'incubation': 0}):
+            return [GroupSplitSpec(p=1, attr_set={'flu': 'i'})]
+        return [GroupSplitSpec(p=1, attr_set={'incubation': group.get_attr('incubation') - 1})]
+
+
+class RecoveryRule(Rule):
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('recovery', t, i, group_qry=GroupQry(attr={'flu': 'i'}), memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        return [
+            GroupSplitSpec(p=0.05, attr_set=Group.VOID),
+            GroupSplitSpec(p=0.25, attr_set={'flu': 's'}),
+            GroupSplitSpec(p=0.70)
+        ]
+
+
+class CensusRule(Rule):
+    # queries the whole model in aggregate, which is answered from its indexes and query cache
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('census', t, i, group_qry=GroupQry(attr={'flu': 's'}), memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        n = pop.get_groups_mass(GroupQry(attr={'ward': group.get_attr('ward'), 'flu': 'i'}))
+        p = min(pop.get_groups_mass(GroupQry(attr={'flu': 'i'})) / 100, 0.5)  # the same for every agent
+        return [GroupSplitSpec(p=p, attr_set={'seen': n}), GroupSplitSpec(p=1 - p)]
+
+
+class SIRSRule(Rule):
+    # reads only what it writes of each agent, so can change agents as they step
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('sirs', t, i, memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        if group.has_attr({'flu': 's'}):
+            return [GroupSplitSpec(p=0.05, attr_set={'flu': 'i'}), GroupSplitSpec(p=0.95)]
+        if group.has_attr({'flu': 'i'}):
+            return [GroupSplitSpec(p=0.5, attr_set={'flu': 'r'}), GroupSplitSpec(p=0.5)]
+        return [GroupSplitSpec(p=0.1, attr_set={'flu': 's'}), GroupSplitSpec(p=0.9)]
+
+
+class OutbreakRule(Rule):
+    # queries the whole model for the counters of IncubationRule, which clocks would leave stale
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('outbreak', t, i, group_qry=GroupQry(attr={'flu': 's'}), memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        if len(pop.get_groups(GroupQry(attr={'incubation': 1}))) > 10:
+            return [GroupSplitSpec(p=0.1, attr_set={'flu': 'e', 'incubation': 3}), GroupSplitSpec(p=0.9)]
+        return None
+
+
+class IsolationRule(Rule):
+    # its is_applicable requires agents to hold a ward, which the model checks by the names agents hold
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('isolation', t, i, memo=memo)
+
+    def is_applicable(self, group, iter, t):
+        return super().is_applicable(group, iter, t) and group.has_attr(['ward'])
+
+    def apply(self, pop, group, iter, t):
+        if group.has_attr({'flu': 'i'}):
+            return [GroupSplitSpec(p=0.2, attr_set={'ward': 'c'}), GroupSplitSpec(p=0.8)]
+        return None
+
+
+class ChurnRule(Rule):
+    # agents leave, each replaced by a copy of itself, which the model may build from a removed agent
+    def __init__(self, t=TimeAlways(), i=IterAlways(), memo=None):
+        super().__init__('churn', t, i, memo=memo)
+
+    def apply(self, pop, group, iter, t):
+        if random.random() < 0.1:
+            pop.add_vita_group(group.copy())
+            return [GroupSplitSpec(p=1, attr_set=Group.VOID)]
+        return None
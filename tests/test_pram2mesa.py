@@ -0,0 +1,210 @@
+import importlib
+import random
+import sys
+import pytest
+
+pytest.importorskip('mesa')
+pytest.importorskip('pram')
+
+from pram.entity import Group
+from pram.sim import Simulation
+from pram2mesa.pram2mesa import pram2mesa
+from pram_rules import (ExposureRule, IncubationRule, RecoveryRule, CensusRule, SIRSRule, OutbreakRule, IsolationRule,
+                        ChurnRule)
+
+STEPS = 20
+OPTIONS = ['direct_writes', 'active_rules', 'fused_step', 'timers', 'sparse', 'indexes', 'query_cache', 'presence',
+           'hoisting', 'specialize']
+
+
+def flu_sim(census=True):
+    sim = (Simulation().
+           add_rule(ExposureRule()).
+           add_rule(IncubationRule()).
+           add_rule(RecoveryRule()).
+           add_group(Group(m=150, attr={'flu': 's', 'ward': 'a'})).
+           add_group(Group(m=150, attr={'flu': 's', 'ward': 'b'})).
+           add_group(Group(m=100, attr={'ward': 'c'}))  # no rule applies to these agents
+           )
+    if census:
+        sim.add_rule(CensusRule())
+    return sim
+
+
+def sirs_sim():
+    return Simulation().add_rule(SIRSRule()).add_group(Group(m=400, attr={'flu': 's'}))
+
+
+def isolation_sim():
+    return flu_sim(census=False).add_rule(IsolationRule())
+
+
+def translate(tmp_path, monkeypatch, name, sim, **options):
+    """Translates sim into tmp_path, returning the new Model class and the text of the new Agent and Model files"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    pram2mesa(sim, name, autopep=False, **options)
+    model = getattr(importlib.import_module(f'{name}.{name}Model'), f'{name}Model')
+    return model, ''.join((tmp_path / name / f'{name}{kind}.py').read_text() for kind in ('Agent', 'Model'))
+
+
+def run(model_class, steps=STEPS, seed=1):
+    """Runs a new model for a number of steps with a fixed seed, returning it"""
+    random.seed(seed)
+    model = model_class.__new__(model_class, seed=seed)
+    model.__init__()
+    for _ in range(steps):
+        model.step()
+    return model
+
+
+def state(model):
+    return sorted((a.unique_id, a.get('flu'), a.get('incubation'), a.get('ward'), a.get('seen'))
+                  for a in model.schedule.agents)
+
+
+def test_translate(tmp_path, monkeypatch):
+    model_class, _ = translate(tmp_path, monkeypatch, 'Flu', flu_sim(census=False))
+    for suffix in ('Agent.py', 'Model.py', 'Groups.json', 'Rules.json', 'Sites.json'):
+        assert (tmp_path / 'Flu' / f'Flu{suffix}').exists()
+    model = run(model_class, steps=0)
+    assert len(model.schedule.agents) == 400
+    assert sum(a.get('flu') == 's' for a in model.schedule.agents) == 300
+    model = run(model_class)
+    assert {a.get('flu') for a in model.schedule.agents} <= {'s', 'e', 'i', None}
+    assert len(model.schedule.agents) < 400  # recovery voids agents, which the model removes (see void_queue)
+
+
+def test_modes(tmp_path, monkeypatch):
+    _, code = translate(tmp_path, monkeypatch, 'FluModes', flu_sim(census=False))
+    assert 'Writes: staged' in code  # ExposureRule reads the flu IncubationRule writes
+    assert 'Timers: scheduled' in code
+    assert 'Activation: sparse' in code
+    _, code = translate(tmp_path, monkeypatch, 'SIRSModes', sirs_sim())
+    assert 'Writes: direct' in code
+    # each of two SIRSRules reads the flu the other writes
+    _, code = translate(tmp_path, monkeypatch, 'SIRSTwiceModes', sirs_sim().add_rule(SIRSRule()))
+    assert 'Writes: staged' in code and 'another SIRSRule' in code
+
+
+def test_timers_with_aggregate_queries(tmp_path, monkeypatch):
+    # the census queries agents' flu and ward, not the counters of IncubationRule, so timers still run as clocks; a
+    # rule querying the counters in aggregate keeps them stepped
+    model_class, code = translate(tmp_path, monkeypatch, 'FluCensus', flu_sim())
+    assert 'Timers: scheduled' in code
+    model = run(model_class, steps=5)
+    assert any(model.clocks.values())
+    assert model.query_hits > 0
+    model_class, code = translate(tmp_path, monkeypatch, 'FluOutbreak', flu_sim().add_rule(OutbreakRule()))
+    assert 'Timers: stepped' in code and 'in aggregate' in code
+    run(model_class, steps=5)
+
+
+@pytest.mark.parametrize('timers', [True, False])
+def test_query_timer_counters(tmp_path, monkeypatch, timers):
+    # counters kept as clocks are put back on agents before the model is queried for them
+    model_class, _ = translate(tmp_path, monkeypatch, f'FluQuery{timers}', flu_sim(), timers=timers)
+    group_qry = sys.modules[model_class.__module__].GroupQry
+    model = run(model_class, steps=6)
+    expected = [a for a in model.schedule.agents if a.get('incubation') == 1]
+    assert expected
+    assert model.get_groups(model, group_qry(attr={'incubation': 1})) == expected
+    assert model.get_groups_mass(group_qry(attr={'incubation': 1})) == len(expected)
+    for _ in range(6):
+        model.step()
+    assert model.get_groups_mass(group_qry(attr={'incubation': 1})) == \
+        sum(a.get('incubation') == 1 for a in model.schedule.agents)
+
+
+@pytest.mark.parametrize('option', OPTIONS)
+def test_option_off(tmp_path, monkeypatch, option):
+    # each optimisation changes how rules are run, never what they do
+    sim = {'direct_writes': sirs_sim, 'presence': isolation_sim}.get(option, flu_sim)
+    on, on_code = translate(tmp_path, monkeypatch, f'On_{option}', sim())
+    off, off_code = translate(tmp_path, monkeypatch, f'Off_{option}', sim(), **{option: False})
+    assert on_code.replace('On_', '') != off_code.replace('Off_', '')
+    if option == 'direct_writes':
+        assert 'Writes: staged' in off_code
+    if option in ('timers', 'fused_step', 'active_rules'):
+        assert 'Timers: stepped' in off_code
+    if option in ('sparse', 'fused_step', 'active_rules'):
+        assert 'Activation: full' in off_code
+    assert state(run(on)) == state(run(off))
+
+
+def test_indexes_off(tmp_path, monkeypatch):
+    model = run(translate(tmp_path, monkeypatch, 'FluUnindexed', flu_sim(), indexes=False)[0], steps=5)
+    assert not model.indexed and model.value_index is None
+
+
+def test_query_cache_off(tmp_path, monkeypatch):
+    model = run(translate(tmp_path, monkeypatch, 'FluUncached', flu_sim(), query_cache=False)[0], steps=5)
+    assert model.query_hits == model.query_misses == 0
+
+
+def test_compiled_queries(tmp_path, monkeypatch):
+    # queries rebuilt with equal conditions share one predicate; the predicates kept are bounded
+    model = run(translate(tmp_path, monkeypatch, 'FluCompiled', flu_sim(census=False))[0], steps=0)
+    agents = model.schedule.agents
+    module = sys.modules[type(agents[0]).__module__]
+
+    def in_ward(ward):
+        return lambda agent: agent.get('ward') == ward
+    assert module._cond_key(in_ward('a')) == module._cond_key(in_ward('a')) != module._cond_key(in_ward('b'))
+    match = module._compiled_qry((('flu', 's'),), (), (in_ward('a'),), False)
+    assert match is module._compiled_qry((('flu', 's'),), (), (in_ward('a'),), False)
+    assert match is not module._compiled_qry((('flu', 's'),), (), (in_ward('b'),), False)
+    assert sum(map(match, agents)) == 150
+    info = module._compiled.cache_info()
+    unhashable = module._compiled_qry((('flu', ['s']),), (), (), False)
+    assert not any(map(unhashable, agents)) and module._compiled.cache_info() == info
+    assert info.maxsize == 1024
+
+
+@pytest.mark.parametrize('layout', [{}, {'slots': True}, {'shared_states': True}])
+def test_agent_pool(tmp_path, monkeypatch, layout):
+    # removed agents are reused for births, unless anything still holds them
+    name = 'Churn' + ''.join(k.title().replace('_', '') for k in layout)
+    sim = Simulation().add_rule(ChurnRule()).add_group(Group(m=200, attr={'flu': 's'}))
+    model = run(translate(tmp_path, monkeypatch, name, sim, **layout)[0], steps=0)
+    removed = []
+
+    def keep(agent, key, old, new):
+        removed.append((agent, agent.unique_id))
+    model.subscribe(model.REMOVAL, keep)
+    for _ in range(10):
+        model.step()
+    assert removed and all(agent.unique_id == unique_id for agent, unique_id in removed)
+    assert not {agent for agent, _ in removed} & set(model.schedule.agents)
+    model.unsubscribe(model.REMOVAL, keep)
+    removed.clear()
+    hits = model.pool_hits
+    for _ in range(10):
+        model.step()
+    assert model.pool_hits > hits and len(model.schedule.agents) == 200
+
+
+@pytest.mark.parametrize('layout', [{}, {'slots': True}, {'shared_states': True}])
+def test_categorical_values(tmp_path, monkeypatch, layout):
+    # flu is stored as codes of the values known at translation time; other values are stored as they are
+    name = 'FluCategorical' + ''.join(k.title().replace('_', '') for k in layout)
+    model = run(translate(tmp_path, monkeypatch, name, flu_sim(), **layout)[0], steps=0)
+    agents = model.schedule.agents
+    module = sys.modules[type(agents[0]).__module__]
+    known = list(module._categories['flu'].values)
+    for agent, value in zip(agents, (True, 1, 1.0, ['s'], 'x')):
+        agent.flu = value
+        assert agent.get('flu') == value and type(agent.get('flu')) is type(value)
+    assert model.get_groups(model, module.GroupQry(attr={'flu': 'x'})) == [agents[4]]
+    assert model.get_groups(model, module.GroupQry(attr={'flu': 'y'})) == []
+    assert agents[3].has_attr({'flu': ['s']}) and not agents[4].has_attr({'flu': 'z'})
+    assert module._categories['flu'].values == known
+
+
+@pytest.mark.parametrize('sim', [flu_sim, sirs_sim])
+def test_layouts(tmp_path, monkeypatch, sim):
+    name = sim.__name__.title().replace('_', '')
+    default, _ = translate(tmp_path, monkeypatch, f'{name}Default', sim())
+    slots, _ = translate(tmp_path, monkeypatch, f'{name}Slots', sim(), slots=True)
+    shared, _ = translate(tmp_path, monkeypatch, f'{name}Shared', sim(), shared_states=True)
+    assert state(run(default)) == state(run(slots)) == state(run(shared))